@@ -0,0 +1,43 @@
+import time
+import numpy as np
+from fastdtw import fastdtw
+from scipy.spatial.distance import euclidean
+from dtw import dtw_distance
+from melody_analysis import ensure_novelty_index, load_novelty_index
+from config import SAVE_DIR
+
+
+def time_pairs(distance_function, pairs):
+    """return distances, seconds per pair"""
+    start_time = time.perf_counter()
+    distances = np.array([distance_function(x, y) for x, y in pairs])
+    return distances, (time.perf_counter() - start_time) / len(pairs)
+
+def benchmark_dtw(num_pairs=200, windows=(8, 32), seed=42):
+    """
+    Times fastdtw and the native DTW (exact and banded) on pairs of encoded deutschl
+    songs from the novelty index, and reports how far each one is from the exact distance
+    """
+    ensure_novelty_index(SAVE_DIR)
+    songs = [np.asarray(features) for features in load_novelty_index() if len(features)]
+
+    rng = np.random.default_rng(seed)
+    pairs = [tuple(songs[i] for i in rng.choice(len(songs), 2, replace=False)) for _ in range(num_pairs)]
+    print(f"{num_pairs} pairs of songs, {np.mean([len(x) for x, _ in pairs]):.0f} notes on average")
+
+    engines = {"native exact": lambda x, y: dtw_distance(x, y)}
+    engines["fastdtw"] = lambda x, y: fastdtw(x, y, dist=euclidean)[0]
+    for window in windows:
+        engines[f"native window={window}"] = lambda x, y, window=window: dtw_distance(x, y, window=window)
+
+    results = {name: time_pairs(distance_function, pairs) for name, distance_function in engines.items()}
+    exact = results["native exact"][0]
+    fastdtw_seconds = results["fastdtw"][1]
+
+    for name, (distances, seconds) in results.items():
+        error = np.mean(np.abs(distances - exact) / exact)
+        print(f"{name:20s} {seconds * 1000:8.3f} ms/pair  {fastdtw_seconds / seconds:5.1f}x vs fastdtw  "
+              f"mean relative difference to exact {error:.4%}")
+
+if __name__ == "__main__":
+    benchmark_dtw()
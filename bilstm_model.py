@@ -4,17 +4,25 @@ def build_bilstm_model(
     output_units,
     lstm_units=512,  
     dropout_rate=0.2,
-    dense_units=32
+    dense_units=32,
+    embedding_dim=None
 ):
     """
     Build and return a Bidirectional LSTM model for melody generation.
+    If embedding_dim is given the model takes integer tokens and learns an
+    embedding for them, otherwise it takes one-hot vectors.
     """
-    inputs = keras.layers.Input(shape=(None, output_units))
+    if embedding_dim:
+        inputs = keras.layers.Input(shape=(None,), dtype="int32")
+        x = keras.layers.Embedding(output_units, embedding_dim)(inputs)
+    else:
+        inputs = keras.layers.Input(shape=(None, output_units))
+        x = inputs
     
     # First Bidirectional LSTM layer
     x = keras.layers.Bidirectional(
         keras.layers.LSTM(lstm_units//2, return_sequences=True)
-    )(inputs)
+    )(x)
     x = keras.layers.Dropout(dropout_rate)(x)
     
     # Second Bidirectional LSTM layer
@@ -27,7 +35,8 @@ def build_bilstm_model(
     for _ in range(2):  
         x = keras.layers.Dense(dense_units, activation='relu')(x)
     
-    outputs = keras.layers.Dense(output_units, activation="softmax")(x)
+    # softmax in float32 even with mixed precision
+    outputs = keras.layers.Dense(output_units, activation="softmax", dtype="float32")(x)
     
     model = keras.Model(inputs, outputs)
     return model 
\ No newline at end of file
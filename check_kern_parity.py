@@ -0,0 +1,51 @@
+import sys
+import time
+import music21 as m21
+from kern_parser import encode_kern, UnsupportedKernError
+from preprocess import find_kern_files, process_song
+from config import KERN_DATASET_PATH, ACCEPTABLE_DURATIONS, TIME_STEP
+
+
+def check_kern_parity(dataset_path=KERN_DATASET_PATH, max_files=None):
+    """
+    Encodes every kern file of the dataset with both the fast path and music21 and
+    reports the files where they disagree, how many files fall back to music21 and
+    the time spent by each parser
+    return mismatches (list): paths of the files with different encodings
+    """
+    kern_files = find_kern_files(dataset_path)[:max_files]
+    mismatches = []
+    fallbacks = 0
+    fast_seconds = music21_seconds = 0.0
+
+    for file_path in kern_files:
+        start_time = time.perf_counter()
+        with open(file_path, "r", encoding="latin-1") as fp:
+            text = fp.read()
+        try:
+            fast_song = encode_kern(text, ACCEPTABLE_DURATIONS, TIME_STEP)
+        except UnsupportedKernError:
+            fallbacks += 1
+            continue
+        fast_seconds += time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        song = process_song(m21.converter.parse(file_path))
+        music21_seconds += time.perf_counter() - start_time
+
+        if fast_song != song:
+            mismatches.append(file_path)
+            print(f"Mismatch: {file_path}")
+
+    checked = len(kern_files) - fallbacks
+    print(f"{len(kern_files)} files, {fallbacks} fall back to music21, {len(mismatches)} mismatches out of {checked}")
+    if checked:
+        print(f"fast path {1000 * fast_seconds / checked:.2f} ms/file, "
+              f"music21 {1000 * music21_seconds / checked:.2f} ms/file "
+              f"({music21_seconds / max(fast_seconds, 1e-9):.0f}x)")
+    return mismatches
+
+
+if __name__ == "__main__":
+    mismatches = check_kern_parity(*sys.argv[1:2])
+    sys.exit(1 if mismatches else 0)
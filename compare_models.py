@@ -1,31 +1,36 @@
 import matplotlib.pyplot as plt
-from train_lstm import train_lstm
-from train_bilstm import train_bilstm
-from melody_analysis import analyze_melody_novelty
+from training_runner import train_models
+from melody_analysis import analyze_melody_novelty, ensure_novelty_index
 from config import OUTPUT_UNITS, LOSS, LEARNING_RATE, EPOCHS, BATCH_SIZE, SEQUENCE_LENGTH
 from melody_generator import MelodyGenerator
 import numpy as np
 
-def compare_models(training_dataset_path):
-    # Train LSTM model
-    print("Training LSTM model...")
-    lstm_history, lstm_time, lstm_loss, lstm_accuracy = train_lstm(
-        output_units=OUTPUT_UNITS,
-        loss=LOSS,
-        learning_rate=LEARNING_RATE,
-        epochs=EPOCHS,
-        batch_size=BATCH_SIZE
-    )
-
-    # Train Bi-LSTM model
-    print("\nTraining Bi-LSTM model...")
-    bilstm_history, bilstm_time, bilstm_loss, bilstm_accuracy = train_bilstm(
-        output_units=OUTPUT_UNITS,
-        loss=LOSS,
-        learning_rate=LEARNING_RATE,
-        epochs=EPOCHS,
-        batch_size=BATCH_SIZE
+def compare_models(training_dataset_path, save_midi=True, parallel=False, num_threads=None, retrain=False):
+    """
+    Trains (or reuses) both models on the same data, generates a melody with each and compares them.
+    :param parallel: train the two models at the same time in separate processes
+    :param num_threads: TensorFlow threads per training process
+    :param retrain: train again even if models with the same config and data exist
+    """
+    # Train the LSTM and Bi-LSTM models on training data built once
+    print("Training LSTM and Bi-LSTM models...")
+    results = train_models(
+        ("lstm", "bilstm"),
+        params=dict(
+            output_units=OUTPUT_UNITS,
+            loss=LOSS,
+            learning_rate=LEARNING_RATE,
+            epochs=EPOCHS,
+            batch_size=BATCH_SIZE
+        ),
+        parallel=parallel,
+        num_threads=num_threads,
+        retrain=retrain
     )
+    lstm_history, lstm_time = results["lstm"]["history"], results["lstm"]["training_time"]
+    lstm_loss, lstm_accuracy = results["lstm"]["test_loss"], results["lstm"]["test_accuracy"]
+    bilstm_history, bilstm_time = results["bilstm"]["history"], results["bilstm"]["training_time"]
+    bilstm_loss, bilstm_accuracy = results["bilstm"]["test_loss"], results["bilstm"]["test_accuracy"]
 
     seed = "69 _ _ _ 69 _ _"
     
@@ -36,7 +41,9 @@ def compare_models(training_dataset_path):
         num_steps=500,
         temperature=0.3
     )
-    mg_lstm.save_melody(lstm_melody, file_name="lstm_output")
+    exports = []
+    if save_midi:
+        exports.append(mg_lstm.save_melody_async(lstm_melody, file_name="lstm_output"))
 
     # Generate with Bi-LSTM model
     mg_bilstm = MelodyGenerator("bilstm_model.h5", "bilstm")
@@ -45,12 +52,14 @@ def compare_models(training_dataset_path):
         num_steps=500,
         temperature=0.7
     )
-    mg_bilstm.save_melody(bilstm_melody, file_name="bilstm_output")
+    if save_midi:
+        exports.append(mg_bilstm.save_melody_async(bilstm_melody, file_name="bilstm_output"))
 
     
-    # Analyze novelty
-    lstm_novelty = analyze_melody_novelty("lstm_output.mid", training_dataset_path)
-    bilstm_novelty = analyze_melody_novelty("bilstm_output.mid", training_dataset_path)
+    # Analyze novelty of the generated symbols against features of the training data extracted once
+    ensure_novelty_index(training_dataset_path)
+    lstm_novelty = analyze_melody_novelty(lstm_melody, training_dataset_path)
+    bilstm_novelty = analyze_melody_novelty(bilstm_melody, training_dataset_path)
 
     print("\nComparison Results:")
     print("-" * 50)
@@ -72,10 +81,10 @@ def compare_models(training_dataset_path):
     
     # Loss plot
     plt.subplot(2, 2, 1)
-    plt.plot(lstm_history.history['loss'], label='LSTM Training Loss')
-    plt.plot(lstm_history.history['val_loss'], label='LSTM Validation Loss')
-    plt.plot(bilstm_history.history['loss'], label='Bi-LSTM Training Loss')
-    plt.plot(bilstm_history.history['val_loss'], label='Bi-LSTM Validation Loss')
+    plt.plot(lstm_history['loss'], label='LSTM Training Loss')
+    plt.plot(lstm_history['val_loss'], label='LSTM Validation Loss')
+    plt.plot(bilstm_history['loss'], label='Bi-LSTM Training Loss')
+    plt.plot(bilstm_history['val_loss'], label='Bi-LSTM Validation Loss')
     plt.title('Model Loss Comparison')
     plt.xlabel('Epoch')
     plt.ylabel('Loss')
@@ -83,10 +92,10 @@ def compare_models(training_dataset_path):
     
     # Accuracy plot
     plt.subplot(2, 2, 2)
-    plt.plot(lstm_history.history['accuracy'], label='LSTM Training Accuracy')
-    plt.plot(lstm_history.history['val_accuracy'], label='LSTM Validation Accuracy')
-    plt.plot(bilstm_history.history['accuracy'], label='Bi-LSTM Training Accuracy')
-    plt.plot(bilstm_history.history['val_accuracy'], label='Bi-LSTM Validation Accuracy')
+    plt.plot(lstm_history['accuracy'], label='LSTM Training Accuracy')
+    plt.plot(lstm_history['val_accuracy'], label='LSTM Validation Accuracy')
+    plt.plot(bilstm_history['accuracy'], label='Bi-LSTM Training Accuracy')
+    plt.plot(bilstm_history['val_accuracy'], label='Bi-LSTM Validation Accuracy')
     plt.title('Model Accuracy Comparison')
     plt.xlabel('Epoch')
     plt.ylabel('Accuracy')
@@ -103,5 +112,9 @@ def compare_models(training_dataset_path):
     plt.tight_layout()
     plt.savefig('lstm_bilstm_comparison.png')
 
+    # make sure the MIDI files are written before returning
+    for export in exports:
+        export.result()
+
 if __name__ == "__main__":
     compare_models("dataset") 
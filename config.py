@@ -1,18 +1,97 @@
 # configuration for training
-OUTPUT_UNITS = 32
+# size of the output layer (and one-hot input); None uses the size of the vocabulary
+OUTPUT_UNITS = None
 NUM_UNITS = [256]
 LOSS = "sparse_categorical_crossentropy"
 LEARNING_RATE = 0.001
 EPOCHS = 50
 BATCH_SIZE = 64
 SAVE_MODEL_PATH = "model.h5"
+# stream batches of windows with tf.data instead of building the whole one-hot dataset in memory
+STREAM_TRAINING_DATA = False
+# size of the token embedding; None feeds one-hot vectors to the models instead
+EMBEDDING_DIM = None
+# "performance" trains with the PERFORMANCE_* settings below, "default" with TensorFlow's defaults
+TRAINING_PROFILE = "default"
+# bfloat16 mixed precision, only applied if the CPU supports bfloat16 (AVX512_BF16/AMX)
+PERFORMANCE_MIXED_PRECISION = True
+# XLA compilation of the train step
+PERFORMANCE_JIT_COMPILE = True
+# TensorFlow thread pools (None = number of CPUs)
+PERFORMANCE_INTRA_OP_THREADS = None
+PERFORMANCE_INTER_OP_THREADS = 2
+# deutschl collections to train on, assembled from their shards; None trains on INT_DATASET as it is
+TRAINING_COLLECTIONS = None
 
 # configuration for preprocessing
 KERN_DATASET_PATH = "deutschl/altdeu2"
+# sharded builds: one shard of encoded songs per collection of KERN_ROOT, listed in SHARDS_DIR/manifest.json
+KERN_ROOT = "deutschl"
+KERN_COLLECTIONS = ["altdeu2"]
+SHARDS_DIR = "shards"
 SINGLE_FILE_DATASET = "file_dataset"
+# integer tokens of the single file dataset, memory mapped for training
+INT_DATASET = "file_dataset.npy"
 MAPPING_PATH = "mapping.json"
+# sorted symbols with their counts; mapping.json is derived from it
+VOCABULARY_PATH = "vocabulary.json"
 SEQUENCE_LENGTH = 64
 SAVE_DIR = "dataset"
+# number of worker processes used by preprocess (1 = serial)
+NUM_WORKERS = 1
+# cache of encoded songs keyed by kern file content and preprocessing settings (None = disabled)
+CACHE_DIR = "cache"
+TIME_STEP = 0.25
+# tokenize plain single spine kern files without music21, falling back to music21 for the rest
+KERN_FAST_PATH = True
 ACCEPTABLE_DURATIONS=[
     0.25 , 0.5 , 0.75 , 1.0 , 1.5 , 2 , 3 , 4
-]
\ No newline at end of file
+]
+
+# configuration for the training benchmark (training_benchmark.py)
+BENCHMARK_COLLECTIONS = ["kinder"]
+BENCHMARK_DIR = "benchmark"
+BENCHMARK_RESULTS_PATH = "benchmark_results.json"
+BENCHMARK_EPOCHS = 2
+# values swept one at a time around BATCH_SIZE, SEQUENCE_LENGTH and NUM_UNITS[0]
+BENCHMARK_BATCH_SIZES = [32, 64, 128]
+BENCHMARK_SEQUENCE_LENGTHS = [32, 64]
+BENCHMARK_NUM_UNITS = [128, 256]
+
+# configuration for the generation benchmark (generation_benchmark.py)
+GENERATION_BENCHMARK_BATCH_SIZES = [1, 8, 32]
+GENERATION_BENCHMARK_SEED_LENGTHS = [8, 64]
+# generation steps timed per batch size and seed length
+GENERATION_BENCHMARK_STEPS = 128
+GENERATION_BENCHMARK_RESULTS_PATH = "generation_benchmark.json"
+
+# configuration for the TFLite export (tflite_export.py)
+# "dynamic" (int8 weights, float32 activations) or None (float32)
+TFLITE_QUANTIZATION = "dynamic"
+# the exported models take batches of this size; bigger batches are run in chunks
+TFLITE_BATCH_SIZE = 1
+# interpreter threads (None = TFLite's default)
+TFLITE_NUM_THREADS = None
+# dataset windows used to validate an export
+TFLITE_VALIDATION_WINDOWS = 500
+# largest mean KL divergence between the Keras and TFLite next symbol distributions accepted
+TFLITE_MAX_KL = 0.01
+
+# configuration for the novelty analysis
+NOVELTY_INDEX_PATH = "novelty_index.npy"
+# "native" uses the vectorized DTW in dtw.py, "fastdtw" the fastdtw package
+DTW_ENGINE = "native"
+# Sakoe-Chiba band radius of the native DTW; None computes the exact distance
+DTW_WINDOW = None
+
+# configuration for the melody server
+SERVER_HOST = "127.0.0.1"
+SERVER_PORT = 8000
+SERVER_MAX_BATCH_SIZE = 64
+# seconds to wait for more requests before running a batch
+SERVER_BATCH_DELAY = 0.005
+# longest melody continuation a request can ask for (num_steps)
+SERVER_MAX_STEPS = 1000
+# LSTM only: carry the LSTM state forward instead of re-running the window every step. Faster,
+# but the state sees the whole history while generate_melody (and training) see SEQUENCE_LENGTH symbols
+SERVER_INCREMENTAL = False
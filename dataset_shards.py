@@ -0,0 +1,145 @@
+import os
+import sys
+import json
+import hashlib
+from collections import Counter
+import numpy as np
+from preprocess import find_kern_files, encode_kern_files, song_cache_key
+from vocabulary import build_vocabulary, save_vocabulary, mappings_from_vocabulary
+from config import KERN_ROOT, KERN_COLLECTIONS, SHARDS_DIR, SEQUENCE_LENGTH, MAPPING_PATH, VOCABULARY_PATH, INT_DATASET, NUM_WORKERS, CACHE_DIR
+
+MANIFEST_NAME = "manifest.json"
+DELIMITER = "/"
+
+
+def load_manifest(shards_dir=SHARDS_DIR):
+    """return manifest (dict): collection name -> shard entry, empty if nothing was built yet"""
+    manifest_path = os.path.join(shards_dir, MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return {}
+
+    with open(manifest_path, "r") as fp:
+        return json.load(fp)
+
+def save_manifest(manifest, shards_dir=SHARDS_DIR):
+    manifest_path = os.path.join(shards_dir, MANIFEST_NAME)
+    tmp_path = f"{manifest_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as fp:
+        json.dump(manifest, fp, indent=4)
+    os.replace(tmp_path, manifest_path)
+
+def collection_fingerprint(kern_files):
+    """Hash of the cache keys of all the files of a collection: changes whenever a file or a
+    preprocessing setting changes"""
+    hasher = hashlib.sha256()
+    for file_path in kern_files:
+        hasher.update(song_cache_key(file_path).encode())
+    return hasher.hexdigest()
+
+def build_shard(collection, kern_root=KERN_ROOT, shards_dir=SHARDS_DIR, num_workers=NUM_WORKERS, cache_dir=CACHE_DIR):
+    """
+    Encodes the songs of one deutschl collection into shards_dir/<collection>.txt, one song
+    per line, without delimiters so that the shard doesn't depend on the sequence length
+    return entry (dict): manifest entry with the song and token counts and the symbol counts
+    """
+    kern_files = find_kern_files(os.path.join(kern_root, collection))
+    if not kern_files:
+        raise FileNotFoundError(f"No kern files found for collection '{collection}' in {kern_root}")
+
+    shard_path = os.path.join(shards_dir, collection + ".txt")
+    symbol_counts = Counter()
+    num_songs = 0
+
+    with open(shard_path + ".tmp", "w") as fp:
+        for encoded_song in encode_kern_files(kern_files, num_workers, cache_dir):
+            if encoded_song is None:
+                continue
+            symbol_counts.update(encoded_song.split())
+            num_songs += 1
+            fp.write(encoded_song + "\n")
+    os.replace(shard_path + ".tmp", shard_path)
+
+    return {
+        "shard": os.path.basename(shard_path),
+        "fingerprint": collection_fingerprint(kern_files),
+        "num_files": len(kern_files),
+        "num_songs": num_songs,
+        "num_tokens": sum(symbol_counts.values()),
+        "symbol_counts": dict(symbol_counts)
+    }
+
+def build_shards(collections=KERN_COLLECTIONS, kern_root=KERN_ROOT, shards_dir=SHARDS_DIR,
+                 num_workers=NUM_WORKERS, cache_dir=CACHE_DIR, rebuild=False):
+    """
+    Builds one shard per collection and records them in the manifest. Collections whose kern
+    files and preprocessing settings haven't changed since their shard was built are skipped
+    return manifest (dict):
+    """
+    os.makedirs(shards_dir, exist_ok=True)
+    manifest = load_manifest(shards_dir)
+
+    for collection in collections:
+        entry = manifest.get(collection)
+        if entry and not rebuild and os.path.exists(os.path.join(shards_dir, entry["shard"])):
+            kern_files = find_kern_files(os.path.join(kern_root, collection))
+            if collection_fingerprint(kern_files) == entry["fingerprint"]:
+                print(f"{collection}: up to date ({entry['num_songs']} songs)")
+                continue
+
+        manifest[collection] = build_shard(collection, kern_root, shards_dir, num_workers, cache_dir)
+        save_manifest(manifest, shards_dir)
+        print(f"{collection}: {manifest[collection]['num_songs']} songs, {manifest[collection]['num_tokens']} tokens")
+
+    return manifest
+
+def merge_symbol_counts(manifest, collections, sequence_length=SEQUENCE_LENGTH):
+    """Symbol counts of the dataset made of the given collections, delimiters included"""
+    symbol_counts = Counter()
+    for collection in collections:
+        symbol_counts.update(manifest[collection]["symbol_counts"])
+        symbol_counts[DELIMITER] += manifest[collection]["num_songs"] * sequence_length
+    return symbol_counts
+
+def build_training_dataset(collections=KERN_COLLECTIONS, shards_dir=SHARDS_DIR, sequence_length=SEQUENCE_LENGTH,
+                           mapping_path=MAPPING_PATH, int_dataset_path=INT_DATASET, vocabulary_path=VOCABULARY_PATH):
+    """
+    Writes the vocabulary, mapping and integer token dataset used for training for a set of
+    collections, straight from their shards: no kern file is parsed again.
+    The vocabulary comes from the merged symbol counts of the manifest, so its size and the
+    length of the dataset are known up front and the tokens are written shard by shard
+    into a memory mapped .npy file (same layout as create_single_file_dataset + create_int_dataset)
+    return int_songs (np.memmap):
+    """
+    manifest = load_manifest(shards_dir)
+    missing = [collection for collection in collections if collection not in manifest]
+    if missing:
+        raise KeyError(f"No shards for {missing}, run build_shards first")
+
+    vocabulary = build_vocabulary(merge_symbol_counts(manifest, collections, sequence_length))
+    save_vocabulary(vocabulary, vocabulary_path, mapping_path)
+    mappings = mappings_from_vocabulary(vocabulary)
+
+    dtype = np.uint8 if len(mappings) <= 256 else np.uint16
+    int_songs = np.lib.format.open_memmap(int_dataset_path, mode="w+", dtype=dtype,
+                                          shape=(sum(vocabulary["counts"]),))
+    delimiter = [mappings[DELIMITER]] * sequence_length
+
+    position = 0
+    for collection in collections:
+        with open(os.path.join(shards_dir, manifest[collection]["shard"]), "r") as fp:
+            for line in fp:
+                tokens = [mappings[symbol] for symbol in line.split()] + delimiter
+                int_songs[position:position + len(tokens)] = tokens
+                position += len(tokens)
+
+    int_songs.flush()
+    return int_songs
+
+
+def main():
+    collections = sys.argv[1:] or KERN_COLLECTIONS
+    build_shards(collections)
+    build_training_dataset(collections)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+import numpy as np
+
+
+def dtw_distance(x, y, max_distance=np.inf, window=None):
+    """
+    DTW distance between two sequences of feature vectors, with the Euclidean distance
+    between points (what fastdtw computes with dist=euclidean).
+    The cost matrix is never built: rows are computed one at a time with vectorized
+    operations, keeping only the previous row. Along a row the recurrence
+    D[j] = c[j] + min(a[j], D[j-1]), with a[j] = min(previous[j-1], previous[j]),
+    unrolls to D[j] = S[j] + min over l <= j of (a[l] - S[l-1]) where S is the running
+    sum of c, so it's a cumsum and a minimum.accumulate.
+    :param max_distance: early abandoning: every warping path crosses every row, so as
+        soon as a whole row is above max_distance inf is returned instead
+    :param window: Sakoe-Chiba band radius (in points of y, around the diagonal);
+        None computes the exact distance, a window gives a faster upper bound (the costs
+        inside the band are computed up front, only the band's cells are visited)
+    """
+    if len(x) == 0 or len(y) == 0:
+        return np.inf
+
+    x = np.asarray(x, dtype="float64").reshape(len(x), -1)
+    y = np.asarray(y, dtype="float64").reshape(len(y), -1)
+    n, m = len(x), len(y)
+
+    if window is None:
+        bands = [(0, m)] * n
+    else:
+        # band of every row; it must stay wide enough for a path to get from (0, 0) to (n - 1, m - 1)
+        # and hold at least one cell per row (y shorter than x)
+        slope = (m - 1) / max(n - 1, 1)
+        centres = np.arange(n) * slope
+        radius = max(window, slope, 1)
+        los = np.maximum(0, np.ceil(centres - radius)).astype(int)
+        his = np.minimum(m, (centres + radius).astype(int) + 1)
+        bands = list(zip(los.tolist(), his.tolist()))
+
+        # the costs inside the band (at most n * (2 * radius + 1) of them) and their running
+        # sums are computed for all the rows at once, only the recurrence is left per row
+        columns = los[:, np.newaxis] + np.arange((his - los).max())
+        band_costs = np.sqrt(np.sum((y[np.minimum(columns, m - 1)] - x[:, np.newaxis]) ** 2, axis=2))
+        band_running_costs = np.cumsum(band_costs, axis=1)
+
+    # previous[j + 1] is the distance up to cell (i - 1, j)
+    previous = np.full(m + 1, np.inf)
+    previous[0] = 0.0
+    current = np.full(m + 1, np.inf)
+    # cells written into current two rows ago and into previous one row ago, reset to inf
+    # before the array is reused
+    stale = (1, m + 1)
+    written = (1, m + 1)
+
+    for i, (lo, hi) in enumerate(bands):
+        if window is None:
+            cost = np.sqrt(np.sum((y - x[i]) ** 2, axis=1))
+            running_cost = np.cumsum(cost)
+        else:
+            cost = band_costs[i, :hi - lo]
+            running_cost = band_running_costs[i, :hi - lo]
+        diagonal_or_up = np.minimum(previous[lo:hi], previous[lo + 1:hi + 1])
+
+        current[stale[0]:stale[1]] = np.inf
+        current[0] = np.inf
+        row = current[lo + 1:hi + 1]
+        np.subtract(diagonal_or_up, running_cost - cost, out=row)
+        np.minimum.accumulate(row, out=row)
+        row += running_cost
+
+        if row.min() > max_distance:
+            return np.inf
+        previous, current = current, previous
+        stale, written = written, (lo + 1, hi + 1)
+
+    return previous[m]
+
+def dtw(x, y, window=None):
+    """fastdtw-style interface: return (distance, None); no warping path is kept"""
+    return dtw_distance(x, y, window=window), None
+
+def lb_kim(x, y):
+    """Lower bound on the DTW distance: every warping path starts at the first pair of
+    points and ends at the last pair"""
+    x = np.asarray(x, dtype="float64")
+    y = np.asarray(y, dtype="float64")
+    bound = np.linalg.norm(x[0] - y[0])
+    if len(x) > 1 or len(y) > 1:
+        bound += np.linalg.norm(x[-1] - y[-1])
+    return bound
+
+def lb_keogh(x, y):
+    """
+    Lower bound on the DTW distance: every point of x is matched with at least one point
+    of y, so it costs at least its distance to the envelope (bounding box) of y.
+    Without a warping window the envelope covers the whole of y; the bound is computed
+    both ways round and the larger one is returned.
+    """
+    x = np.asarray(x, dtype="float64")
+    y = np.asarray(y, dtype="float64")
+
+    def envelope_distance(a, b):
+        lower, upper = b.min(axis=0), b.max(axis=0)
+        outside = np.maximum(a - upper, 0.0) + np.maximum(lower - a, 0.0)
+        return np.sum(np.sqrt(np.sum(outside ** 2, axis=1)))
+
+    return max(envelope_distance(x, y), envelope_distance(y, x))
@@ -0,0 +1,172 @@
+import io
+import os
+import sys
+import contextlib
+import json
+import time
+import platform
+import tempfile
+import numpy as np
+from melody_generator import MelodyGenerator
+from midi_writer import write_midi
+from lstm_model import build_lstm_model
+from bilstm_model import build_bilstm_model
+from training_runner import MODEL_PATHS
+from tflite_export import tflite_path
+from training_benchmark import git_commit
+from vocabulary import load_vocabulary, mappings_from_vocabulary
+from config import (VOCABULARY_PATH, GENERATION_BENCHMARK_BATCH_SIZES, GENERATION_BENCHMARK_SEED_LENGTHS,
+                    GENERATION_BENCHMARK_STEPS, GENERATION_BENCHMARK_RESULTS_PATH)
+
+# symbols of the vocabulary used by random models when there is no vocabulary.json
+DEFAULT_SYMBOLS = [str(midi) for midi in range(55, 85)] + ["/", "_", "r"]
+
+
+def random_generator(model_type, lstm_units=64, rng=None):
+    """MelodyGenerator on a randomly initialized model, built with the same builders as the
+    trained ones, so that generation can be benchmarked without training first"""
+    if os.path.exists(VOCABULARY_PATH):
+        mappings = mappings_from_vocabulary(load_vocabulary())
+    else:
+        mappings = {symbol: i for i, symbol in enumerate(DEFAULT_SYMBOLS)}
+
+    builder = build_lstm_model if model_type == "lstm" else build_bilstm_model
+    model = builder(output_units=len(mappings), lstm_units=lstm_units)
+    return MelodyGenerator(None, model_type, rng=rng, model=model, mappings=mappings)
+
+def random_seeds(generator, batch_size, seed_length, rng):
+    """Random seeds of seed_length symbols (the end symbol "/" left out)"""
+    symbols = [symbol for symbol in generator._mappings if symbol != "/"]
+    return [" ".join(rng.choice(symbols, seed_length)) for _ in range(batch_size)]
+
+def percentiles_ms(latencies):
+    latencies = 1000 * np.asarray(latencies)
+    return {f"p{q}_ms": float(np.percentile(latencies, q)) for q in (50, 95, 99)}
+
+def benchmark_generation_run(generator, batch_size, seed_length, num_steps, incremental, rng):
+    """
+    Generates until at least num_steps steps are timed (random models often emit the end
+    symbol early, so generation is restarted as needed). Each step produces one token for
+    every melody of the batch that hasn't ended yet.
+    return run (dict): per-token latency percentiles, tokens/sec and time per stage
+    """
+    # warm up, which also builds and traces the step model for incremental decoding
+    generator.generate_batch(random_seeds(generator, batch_size, seed_length, rng), 2, incremental=incremental)
+
+    step_latencies = []
+    stage_latencies = {stage: [] for stage in generator.stage_latencies}
+    num_tokens = 0
+    melodies = []
+    generation_time = 0.0
+
+    while len(step_latencies) < num_steps:
+        seeds = random_seeds(generator, batch_size, seed_length, rng)
+        start_time = time.perf_counter()
+        if batch_size == 1:
+            batch = [generator.generate_melody(seeds[0], num_steps - len(step_latencies), incremental=incremental)]
+        else:
+            batch = generator.generate_batch(seeds, num_steps - len(step_latencies), incremental=incremental)
+        generation_time += time.perf_counter() - start_time
+
+        # a melody that ended also produced the end symbol, which isn't in the melody
+        steps = len(generator.step_latencies)
+        num_tokens += sum(min(len(melody) - seed_length + 1, steps) for melody in batch)
+        step_latencies.extend(generator.step_latencies)
+        for stage, latencies in generator.stage_latencies.items():
+            stage_latencies[stage].extend(latencies)
+        melodies.extend(batch)
+
+    # MIDI export of everything that was generated: direct writer and music21
+    export_times = {}
+    with tempfile.TemporaryDirectory() as directory:
+        start_time = time.perf_counter()
+        for i, melody in enumerate(melodies):
+            write_midi(melody, os.path.join(directory, f"{i}.mid"))
+        export_times["midi_native"] = (time.perf_counter() - start_time) / len(melodies)
+
+        start_time = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            for i, melody in enumerate(melodies):
+                generator.save_melody(melody, file_name=os.path.join(directory, f"m21_{i}"))
+        export_times["midi_music21"] = (time.perf_counter() - start_time) / len(melodies)
+
+    return dict(
+        model=generator.model_type,
+        backend=generator.backend,
+        decoding="incremental" if incremental else "windowed",
+        batch_size=batch_size,
+        seed_length=seed_length,
+        steps=len(step_latencies),
+        tokens=num_tokens,
+        tokens_per_second=num_tokens / generation_time,
+        per_token=percentiles_ms(step_latencies),
+        stages_ms={stage: 1000 * float(np.mean(latencies)) for stage, latencies in stage_latencies.items()},
+        export_ms_per_melody={name: 1000 * seconds for name, seconds in export_times.items()}
+    )
+
+def benchmark_generation(model_types=("lstm", "bilstm"), batch_sizes=GENERATION_BENCHMARK_BATCH_SIZES,
+                         seed_lengths=GENERATION_BENCHMARK_SEED_LENGTHS, num_steps=GENERATION_BENCHMARK_STEPS,
+                         random_models=False, results_path=GENERATION_BENCHMARK_RESULTS_PATH, seed=42,
+                         backend="keras"):
+    """
+    Loads each model once and benchmarks generation at every batch size and seed length,
+    with windowed decoding and, for the LSTM, incremental decoding.
+    Per-token latency is the time of one generation step (one new token per melody).
+    :param random_models: use randomly initialized models instead of the trained .h5 files
+        (also used for a model whose file doesn't exist)
+    :param backend: "tflite" benchmarks the models exported by tflite_export.py instead
+        (windowed decoding only)
+    Results are printed and appended to results_path (JSON)
+    return session (dict):
+    """
+    rng = np.random.default_rng(seed)
+    session = {
+        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "commit": git_commit(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "runs": []
+    }
+
+    for model_type in model_types:
+        if backend == "tflite":
+            if not os.path.exists(tflite_path(MODEL_PATHS[model_type])):
+                print(f"Skipping {model_type}, export it first with tflite_export.py")
+                continue
+            source = tflite_path(MODEL_PATHS[model_type])
+            generator = MelodyGenerator(source, model_type, rng=seed, backend="tflite")
+        elif random_models or not os.path.exists(MODEL_PATHS[model_type]):
+            print(f"Benchmarking a randomly initialized {model_type} model")
+            generator = random_generator(model_type, rng=seed)
+            source = "random"
+        else:
+            generator = MelodyGenerator(MODEL_PATHS[model_type], model_type, rng=seed)
+            source = MODEL_PATHS[model_type]
+
+        decodings = [False, True] if model_type == "lstm" and backend == "keras" else [False]
+        for incremental in decodings:
+            for batch_size in batch_sizes:
+                for seed_length in seed_lengths:
+                    run = benchmark_generation_run(generator, batch_size, seed_length, num_steps, incremental, rng)
+                    run["source"] = source
+                    session["runs"].append(run)
+                    print(f"{model_type:6s} {backend:6s} {run['decoding']:11s} batch {batch_size:3d} seed {seed_length:3d}: "
+                          f"p50 {run['per_token']['p50_ms']:6.2f} p95 {run['per_token']['p95_ms']:6.2f} "
+                          f"p99 {run['per_token']['p99_ms']:6.2f} ms/token, {run['tokens_per_second']:8.1f} tokens/s | "
+                          + " ".join(f"{stage} {ms:.2f}" for stage, ms in run["stages_ms"].items())
+                          + f" ms | MIDI {run['export_ms_per_melody']['midi_native']:.2f} ms native, "
+                          f"{run['export_ms_per_melody']['midi_music21']:.2f} ms music21")
+
+    history = []
+    if os.path.exists(results_path):
+        with open(results_path, "r") as fp:
+            history = json.load(fp)
+    history.append(session)
+    with open(results_path, "w") as fp:
+        json.dump(history, fp, indent=4)
+    return session
+
+
+if __name__ == "__main__":
+    benchmark_generation(random_models="--random" in sys.argv[1:],
+                         backend="tflite" if "--tflite" in sys.argv[1:] else "keras")
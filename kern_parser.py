@@ -0,0 +1,110 @@
+import re
+
+# the subset of **kern handled without music21: one spine of plain notes and rests
+NOTE_TOKEN = re.compile(r"^[{(\[]*(\d+)(\.*)([a-gA-G]+|r)([#\-n]*)[\])}]*$")
+METER = re.compile(r"^\*M\d+/\d+$")
+KEY_SIGNATURE = re.compile(r"^\*k\[([a-g][#\-]+)*\]$")
+KEY = re.compile(r"^\*([a-gA-G])([#\-]*):$")
+
+PITCH_CLASSES = {"c": 0, "d": 2, "e": 4, "f": 5, "g": 7, "a": 9, "b": 11}
+
+
+class UnsupportedKernError(ValueError):
+    """Raised for kern files outside of the subset handled by the fast path"""
+
+
+def parse_key(token):
+    """
+    Key of a key interpretation such as "*G:" or "*f#:" (lowercase is minor)
+    return tonic_midi, mode: MIDI number of the tonic in octave 4, "major" or "minor"
+    """
+    letter, accidentals = KEY.match(token).groups()
+    tonic_midi = 60 + PITCH_CLASSES[letter.lower()] + accidentals.count("#") - accidentals.count("-")
+    mode = "minor" if letter.islower() else "major"
+    return tonic_midi, mode
+
+def parse_note(token):
+    """
+    Parses a note or rest token such as "{4a", "8.cc#" or "2r"
+    return midi, quarter_length: midi is None for rests
+    """
+    match = NOTE_TOKEN.match(token)
+    if match is None:
+        raise UnsupportedKernError(f"Unsupported token {token!r}")
+    reciprocal, dots, pitch, accidentals = match.groups()
+
+    if len(set(pitch)) != 1:
+        raise UnsupportedKernError(f"Unsupported token {token!r}")
+    # 0 is a breve
+    reciprocal = int(reciprocal)
+    whole_notes = 2 if reciprocal == 0 else 1 / reciprocal
+    quarter_length = 4 * whole_notes * (2 - 0.5 ** len(dots))
+
+    if pitch == "r":
+        return None, quarter_length
+
+    # c is middle C (octave 4), cc octave 5, C octave 3, CC octave 2...
+    octave = 3 + len(pitch) if pitch.islower() else 4 - len(pitch)
+    midi = 12 * (octave + 1) + PITCH_CLASSES[pitch[0].lower()]
+    midi += accidentals.count("#") - accidentals.count("-")
+    return midi, quarter_length
+
+def parse_kern(text):
+    """
+    Reads the interpretations before the first measure and the notes and rests of a
+    single spine ESAC kern file
+    return header, events: list of interpretation lines and list of (midi or None, quarter_length)
+    """
+    header = []
+    events = []
+    in_header = True
+
+    for line in text.splitlines():
+        if not line or line.startswith("!"):
+            continue
+        if "\t" in line:
+            raise UnsupportedKernError("Only single spine files are supported")
+
+        if line.startswith("**"):
+            if line != "**kern":
+                raise UnsupportedKernError(f"Unsupported spine {line!r}")
+        elif line.startswith("*"):
+            if in_header:
+                header.append(line)
+        elif line.startswith("="):
+            in_header = False
+        else:
+            in_header = False
+            events.append(parse_note(line))
+
+    return header, events
+
+def encode_kern(text, acceptable_durations, time_step=0.25):
+    """
+    Same result as process_song(m21.converter.parse(...)) straight from the kern text:
+    songs with non-acceptable durations are dropped and pitches are transposed to
+    C major/A minor with integer arithmetic
+    return encoded_song (str): None if the song has non-acceptable durations
+    """
+    header, events = parse_kern(text)
+
+    if any(quarter_length not in acceptable_durations for _, quarter_length in events):
+        return None
+
+    # transpose() takes the key from the 5th element of the first measure, which is the
+    # key interpretation only with exactly this header; anything else goes to music21
+    if (len(header) < 5 or not header[0].startswith("*I") or not header[1].startswith("*I")
+            or not METER.match(header[2]) or not KEY_SIGNATURE.match(header[3]) or not KEY.match(header[4])):
+        raise UnsupportedKernError("Unsupported header")
+    tonic_midi, mode = parse_key(header[4])
+
+    # transpose to C4 for major keys and A4 for minor keys
+    semitones = (60 if mode == "major" else 69) - tonic_midi
+
+    encoded_song = []
+    for midi, quarter_length in events:
+        symbol = "r" if midi is None else midi + semitones
+        encoded_song.append(symbol)
+        encoded_song.extend(["_"] * (int(quarter_length / time_step) - 1))
+
+    return " ".join(map(str, encoded_song))
@@ -4,22 +4,31 @@ def build_lstm_model(
     output_units,
     lstm_units=256,
     dropout_rate=0.2,
-    dense_units=32
+    dense_units=32,
+    embedding_dim=None
 ):
     """
     Build and return an LSTM model for melody generation.
+    If embedding_dim is given the model takes integer tokens and learns an
+    embedding for them, otherwise it takes one-hot vectors.
     """
-    inputs = keras.layers.Input(shape=(None, output_units))
+    if embedding_dim:
+        inputs = keras.layers.Input(shape=(None,), dtype="int32")
+        x = keras.layers.Embedding(output_units, embedding_dim)(inputs)
+    else:
+        inputs = keras.layers.Input(shape=(None, output_units))
+        x = inputs
     
     # First LSTM layer
-    x = keras.layers.LSTM(lstm_units)(inputs)
+    x = keras.layers.LSTM(lstm_units)(x)
     x = keras.layers.Dropout(dropout_rate)(x)
     
     # Dense layers
     for _ in range(2):  # Two hidden layers
         x = keras.layers.Dense(dense_units, activation='relu')(x)
     
-    outputs = keras.layers.Dense(output_units, activation="softmax")(x)
+    # softmax in float32 even with mixed precision
+    outputs = keras.layers.Dense(output_units, activation="softmax", dtype="float32")(x)
     
     model = keras.Model(inputs, outputs)
     return model 
@@ -3,6 +3,16 @@ from fastdtw import fastdtw
 from scipy.spatial.distance import euclidean
 from music21 import converter, note, chord
 import os
+import csv
+import json
+import heapq
+import hashlib
+from multiprocessing import Pool
+from dtw import dtw_distance, lb_kim, lb_keogh
+from config import NOVELTY_INDEX_PATH, DTW_ENGINE, DTW_WINDOW
+
+# novelty indexes loaded so far, by index path
+_novelty_indexes = {}
 
 def extract_melody_features_midi(midi_file):
     """Extract features from MIDI file for DTW comparison"""
@@ -31,42 +41,38 @@ def extract_melody_features(melody_sequence):
     - Pitch (MIDI number or 0 for rest)
     - Duration (count of prolongation symbols + 1)
     - Offset (position in sequence)
+    Every symbol other than "_" starts a new event (so does the first symbol), so the
+    events are found with a run-length pass over the whole sequence at once.
     """
-    features = []
-    current_offset = 0.0
-    
-    i = 0
-    while i < len(melody_sequence):
-        note = melody_sequence[i]
-        duration = 1.0
-        j = i + 1
-        while j < len(melody_sequence) and melody_sequence[j] == "_":
-            duration += 1.0
-            j += 1
-        
-        if note == "r":
-            features.append([0.0, duration, current_offset])
-        elif note != "_":
-            try:
-                features.append([
-                    float(note),  
-                    duration,     
-                    current_offset 
-                ])
-            except ValueError:
-                pass
-        
-        current_offset += duration
-        i = j if j > i else i + 1
-    
-    return np.array(features)
+    symbols = np.asarray(melody_sequence, dtype=str)
+    if len(symbols) == 0:
+        return np.empty((0, 3))
+
+    is_start = symbols != "_"
+    is_start[0] = True
+    starts = np.flatnonzero(is_start)
+    durations = np.diff(np.append(starts, len(symbols)))
+
+    # keep rests and notes, drop a leading "_" and other symbols such as "/"
+    event_symbols = symbols[starts]
+    is_rest = event_symbols == "r"
+    is_note = np.char.isdigit(event_symbols)
+    keep = is_rest | is_note
+
+    pitches = np.zeros(len(starts))
+    pitches[is_note] = event_symbols[is_note].astype(float)
+
+    return np.column_stack([pitches, durations, starts]).astype(float)[keep]
 
 def calculate_novelty_score(generated_features, training_features):
     """Calculate novelty score using DTW"""
     if len(generated_features) == 0 or len(training_features) == 0:
         return 0.0
         
-    distance, _ = fastdtw(generated_features, training_features, dist=euclidean)
+    if DTW_ENGINE == "fastdtw":
+        distance, _ = fastdtw(generated_features, training_features, dist=euclidean)
+    else:
+        distance = dtw_distance(generated_features, training_features, window=DTW_WINDOW)
     # Normalize the distance
     max_len = max(len(generated_features), len(training_features))
     normalized_distance = distance / max_len
@@ -75,24 +81,98 @@ def calculate_novelty_score(generated_features, training_features):
     novelty_score = 1 / (1 + normalized_distance)
     return novelty_score
 
-def analyze_melody_novelty(generated_melody, training_dataset_path):
+def dataset_fingerprint(training_dataset_path):
+    """Hash of the names, sizes and modification times of the song files"""
+    hasher = hashlib.sha256()
+    for training_file in sorted(os.listdir(training_dataset_path)):
+        stat = os.stat(os.path.join(training_dataset_path, training_file))
+        hasher.update(f"{training_file}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode())
+    return hasher.hexdigest()
+
+def build_novelty_index(training_dataset_path, index_path=NOVELTY_INDEX_PATH):
+    """
+    Extracts the features of every encoded song in training_dataset_path once and packs
+    them into a single .npy file of (pitch, duration, offset) rows. A JSON sidecar next to
+    it keeps the song files, where each song's rows start and end, and the dataset folder
+    and fingerprint the index was built from.
+    """
+    fingerprint = dataset_fingerprint(training_dataset_path)
+    files = sorted(os.listdir(training_dataset_path))
+    song_features = []
+    for training_file in files:
+        with open(os.path.join(training_dataset_path, training_file), "r") as fp:
+            melody_sequence = fp.read().split()
+        song_features.append(extract_melody_features(melody_sequence).reshape(-1, 3))
+
+    offsets = np.cumsum([0] + [len(features) for features in song_features])
+    np.save(index_path, np.concatenate(song_features) if song_features else np.empty((0, 3)))
+    with open(index_path + ".json", "w") as fp:
+        json.dump({
+            "source": os.path.abspath(training_dataset_path),
+            "fingerprint": fingerprint,
+            "files": files,
+            "offsets": offsets.tolist()
+        }, fp)
+
+    _novelty_indexes.pop(index_path, None)
+
+def ensure_novelty_index(training_dataset_path, index_path=NOVELTY_INDEX_PATH):
+    """Builds the novelty index unless the existing one was built from training_dataset_path
+    as it is now (same folder, same song files, sizes and modification times)"""
+    if os.path.exists(index_path) and os.path.exists(index_path + ".json"):
+        with open(index_path + ".json", "r") as fp:
+            index = json.load(fp)
+        if (index.get("source") == os.path.abspath(training_dataset_path)
+                and index.get("fingerprint") == dataset_fingerprint(training_dataset_path)):
+            return
+
+    build_novelty_index(training_dataset_path, index_path)
+
+def load_novelty_index(index_path=NOVELTY_INDEX_PATH):
+    """
+    Memory maps a novelty index built by build_novelty_index
+    return song_features (list): one (n, 3) feature array per training song
+    """
+    if index_path not in _novelty_indexes:
+        features = np.load(index_path, mmap_mode="r")
+        with open(index_path + ".json", "r") as fp:
+            offsets = json.load(fp)["offsets"]
+        _novelty_indexes[index_path] = [
+            features[start:end] for start, end in zip(offsets[:-1], offsets[1:])
+        ]
+
+    return _novelty_indexes[index_path]
+
+def analyze_melody_novelty(generated_melody, training_dataset_path, index_path=NOVELTY_INDEX_PATH):
     """
     Analyze the novelty of a generated melody compared to training data
     
     Args:
-        generated_melody: List of note symbols from the generated melody
+        generated_melody: List of note symbols from the generated melody, or the path
+            to a MIDI file of it
         training_dataset_path: Path to the folder containing training text files
+        index_path: Novelty index of the training data, (re)built from training_dataset_path
+            if it's missing or was built from other or older data
     """
-    generated_features = extract_melody_features_midi(generated_melody)
-    
+    if isinstance(generated_melody, str):
+        generated_features = extract_melody_features_midi(generated_melody)
+    else:
+        generated_features = extract_melody_features(generated_melody)
+
+    ensure_novelty_index(training_dataset_path, index_path)
+
+    return summarize_novelty_scores(score_against_index(generated_features, index_path))
+
+def score_against_index(generated_features, index_path=NOVELTY_INDEX_PATH):
+    """Novelty score of the generated features against every song of the novelty index"""
     novelty_scores = []
-    for training_file in os.listdir(training_dataset_path):
-        training_features = extract_melody_features(
-            os.path.join(training_dataset_path, training_file)
-        )
+    for training_features in load_novelty_index(index_path):
         score = calculate_novelty_score(generated_features, training_features)
         novelty_scores.append(score)
-    
+
+    return novelty_scores
+
+def summarize_novelty_scores(novelty_scores):
     if not novelty_scores:
         return {
             'average_novelty': 0.0,
@@ -106,4 +186,174 @@ def analyze_melody_novelty(generated_melody, training_dataset_path):
         'std_novelty': np.std(novelty_scores),
         'max_novelty': np.max(novelty_scores),
         'min_novelty': np.min(novelty_scores)
-    } 
+    }
+
+def find_nearest_training_songs(generated_features, song_features, k=5, prune=True):
+    """
+    Finds the k training songs nearest to a generated melody by exact DTW distance
+    (normalised by the longer sequence, as in calculate_novelty_score).
+    Candidates are visited in order of their LB_Kim/LB_Keogh lower bound. Once k songs
+    are found, candidates whose lower bound can't beat the k-th best are pruned, and
+    the DTW of the others is abandoned as soon as it can't beat it either.
+    With prune=False every song gets a full DTW, which gives the same result.
+    return nearest, stats: list of (song index, novelty score) nearest first, and
+        counters of how many candidates were pruned
+    """
+    candidates = [i for i, features in enumerate(song_features) if len(features)]
+    max_lengths = {i: max(len(generated_features), len(song_features[i])) for i in candidates}
+
+    if prune:
+        lower_bounds = {
+            i: max(lb_kim(generated_features, song_features[i]),
+                   lb_keogh(generated_features, song_features[i])) / max_lengths[i]
+            for i in candidates
+        }
+        candidates.sort(key=lambda i: lower_bounds[i])
+
+    stats = {"candidates": len(candidates), "pruned_by_lower_bound": 0, "early_abandoned": 0, "full_dtw": 0}
+
+    # max heap (negated distances) of the k nearest songs found so far
+    nearest = []
+    for position, i in enumerate(candidates):
+        kth_distance = -nearest[0][0] if len(nearest) == k else np.inf
+
+        if prune and lower_bounds[i] >= kth_distance:
+            # candidates are sorted by lower bound, so none of the rest can get closer
+            stats["pruned_by_lower_bound"] = len(candidates) - position
+            break
+
+        max_distance = kth_distance * max_lengths[i] if prune else np.inf
+        distance = dtw_distance(generated_features, song_features[i], max_distance)
+        if distance == np.inf:
+            stats["early_abandoned"] += 1
+            continue
+        stats["full_dtw"] += 1
+
+        normalized_distance = distance / max_lengths[i]
+        if len(nearest) < k:
+            heapq.heappush(nearest, (-normalized_distance, i))
+        elif normalized_distance < kth_distance:
+            heapq.heapreplace(nearest, (-normalized_distance, i))
+
+    nearest = sorted((-distance, i) for distance, i in nearest)
+    return [(i, 1 / (1 + distance)) for distance, i in nearest], stats
+
+def analyze_nearest_neighbours(generated_melody, training_dataset_path, k=5, index_path=NOVELTY_INDEX_PATH):
+    """
+    Nearest neighbour novelty: the k training songs closest to a generated melody
+    
+    Args:
+        generated_melody: List of note symbols from the generated melody, or the path
+            to a MIDI file of it
+        training_dataset_path: Path to the folder containing training text files
+        k: Number of nearest training songs to return
+        index_path: Novelty index of the training data, (re)built from training_dataset_path
+            if it's missing or was built from other or older data
+    """
+    if isinstance(generated_melody, str):
+        generated_features = extract_melody_features_midi(generated_melody)
+    else:
+        generated_features = extract_melody_features(generated_melody)
+
+    ensure_novelty_index(training_dataset_path, index_path)
+    with open(index_path + ".json", "r") as fp:
+        files = json.load(fp)["files"]
+
+    nearest, stats = find_nearest_training_songs(generated_features, load_novelty_index(index_path), k)
+
+    return {
+        'nearest': [(files[i], score) for i, score in nearest],
+        'pruning': stats
+    }
+
+def _score_melody(task):
+    """Worker side of analyze_novelty_batch: one melody against the whole novelty index"""
+    melody_id, melody, index_path = task
+    if isinstance(melody, str):
+        generated_features = extract_melody_features_midi(melody)
+    else:
+        generated_features = extract_melody_features(melody)
+
+    return melody_id, summarize_novelty_scores(score_against_index(generated_features, index_path))
+
+def load_complete_rows(output_path, fieldnames):
+    """
+    Rows of a CSV summary written by analyze_novelty_batch. A run killed while writing can
+    leave a truncated last line: only rows that end with a newline and have every field
+    are kept, and the file is rewritten without the others so that appending continues
+    on a new line
+    return rows (list): one dict per complete row
+    """
+    if not os.path.exists(output_path):
+        return []
+
+    with open(output_path, "r", newline="") as fp:
+        lines = fp.readlines()
+
+    rows = []
+    complete_lines = lines[:1] if lines and lines[0].endswith("\n") else []
+    for line in lines[1:]:
+        row = next(csv.reader([line]), [])
+        if not line.endswith("\n") or len(row) != len(fieldnames):
+            continue
+        try:
+            [float(value) for value in row[1:]]
+        except ValueError:
+            continue
+        rows.append(dict(zip(fieldnames, row)))
+        complete_lines.append(line)
+
+    if len(complete_lines) != len(lines):
+        tmp_path = f"{output_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", newline="") as fp:
+            fp.writelines(complete_lines)
+        os.replace(tmp_path, output_path)
+    return rows
+
+def analyze_novelty_batch(melodies, training_dataset_path, output_path, melody_ids=None, num_workers=None,
+                          chunk_size=256, index_path=NOVELTY_INDEX_PATH):
+    """
+    Scores many generated melodies against the training data in a process pool and
+    appends one row per melody to a CSV summary as soon as it's done.
+    Melodies are sent to the workers chunk_size at a time, so memory stays bounded
+    whatever the number of melodies. Melodies already in output_path are skipped, so
+    an interrupted run can be resumed by calling this again with the same arguments.
+    
+    Args:
+        melodies: List of melodies, each a list of symbols or the path to a MIDI file
+        training_dataset_path: Path to the folder containing training text files
+        output_path: CSV file the results are appended to
+        melody_ids: One id per melody for the CSV; defaults to the MIDI path or the list index
+        num_workers: Number of worker processes (default: one per CPU)
+        chunk_size: Number of melodies in flight at a time
+        index_path: Novelty index of the training data, (re)built from training_dataset_path
+            if it's missing or was built from other or older data
+    return num_scored (int): number of melodies scored by this call
+    """
+    if melody_ids is None:
+        melody_ids = [melody if isinstance(melody, str) else str(i) for i, melody in enumerate(melodies)]
+
+    ensure_novelty_index(training_dataset_path, index_path)
+
+    fieldnames = ["melody_id", "average_novelty", "std_novelty", "max_novelty", "min_novelty"]
+
+    # resume: skip the melodies that were already scored
+    done = {row["melody_id"] for row in load_complete_rows(output_path, fieldnames)}
+    tasks = [
+        (melody_id, melody, index_path)
+        for melody_id, melody in zip(melody_ids, melodies) if melody_id not in done
+    ]
+
+    write_header = not os.path.exists(output_path) or os.path.getsize(output_path) == 0
+
+    with open(output_path, "a", newline="") as fp, Pool(num_workers) as pool:
+        writer = csv.DictWriter(fp, fieldnames=fieldnames)
+        if write_header:
+            writer.writeheader()
+
+        for start in range(0, len(tasks), chunk_size):
+            for melody_id, novelty in pool.imap_unordered(_score_melody, tasks[start:start + chunk_size]):
+                writer.writerow({"melody_id": melody_id, **{k: float(v) for k, v in novelty.items()}})
+                fp.flush()
+
+    return len(tasks)
@@ -1,45 +1,194 @@
+import tensorflow as tf
 import tensorflow.keras as keras
+import os
 import json
+import time
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from preprocess import SEQUENCE_LENGTH, MAPPING_PATH
+from sampling import Sampler
+from midi_writer import write_midi
+from tflite_model import TFLiteModel
+from vocabulary import model_vocabulary_path, load_vocabulary, mappings_from_vocabulary
 import music21 as m21
 
 
 class MelodyGenerator:
-    def __init__(self, model_path, model_type="lstm"):
+    def __init__(self, model_path, model_type="lstm", rng=None, model=None, mappings=None, backend="keras"):
         """
         Constructor that sets up state of the melody generator.
-        :param model_path: path to the trained model (.h5 file)
+        :param model_path: path to the trained model (.h5 file, or .tflite file for the tflite backend)
         :param model_type: type of model ("lstm" or "bilstm")
+        :param rng: numpy.random.Generator or seed used for sampling, for reproducible melodies
+        :param model: Keras model to use instead of loading model_path (e.g. an untrained one)
+        :param mappings: symbol -> int mappings to use instead of the model's vocabulary
+        :param backend: "keras" runs the Keras model, "tflite" a model exported with
+            tflite_export.py through the TFLite interpreter (windowed decoding only, with
+            the window length it was exported with)
         """
         self.model_path = model_path
         self.model_type = model_type.lower()
         if self.model_type not in ["lstm", "bilstm"]:
             raise ValueError("Model type must be either 'lstm' or 'bilstm'")
+        self.backend = backend
+        if self.backend not in ["keras", "tflite"]:
+            raise ValueError("Backend must be either 'keras' or 'tflite'")
 
-        self.model = keras.models.load_model(model_path)
+        if model is not None:
+            self.model = model
+        elif self.backend == "tflite":
+            self.model = TFLiteModel(model_path)
+        else:
+            self.model = keras.models.load_model(model_path)
+
+        # models built with an embedding take integer tokens (batch, steps) instead of one-hot vectors
+        self._integer_input = len(self.model.input_shape) == 2
+
+        # use the vocabulary saved with the model, mapping.json for models saved without one
+        vocabulary_path = model_vocabulary_path(model_path) if model_path else None
+        if mappings is not None:
+            self._mappings = dict(mappings)
+        elif vocabulary_path and os.path.exists(vocabulary_path):
+            self._mappings = mappings_from_vocabulary(load_vocabulary(vocabulary_path))
+        else:
+            with open(MAPPING_PATH, "r") as fp:
+                self._mappings = json.load(fp)
 
-        with open(MAPPING_PATH, "r") as fp:
-            self._mappings = json.load(fp)
+        if self.model.output_shape[-1] != len(self._mappings):
+            raise ValueError(
+                f"{model_path} predicts {self.model.output_shape[-1]} symbols but the vocabulary has "
+                f"{len(self._mappings)}, retrain the model or restore its vocabulary"
+            )
 
         self._start_symbols = ["/"] * SEQUENCE_LENGTH
 
+        # reverse lookup from int to symbol
+        self._symbols = np.empty(len(self._mappings), dtype=object)
+        for symbol, i in self._mappings.items():
+            self._symbols[i] = symbol
+
+        self._sampler = Sampler(rng)
+
+        # lookup table used to one-hot encode model inputs
+        self._one_hot = np.eye(len(self._mappings), dtype="float32")
+
+        if self.backend == "tflite":
+            # the interpreter returns numpy arrays and its tensors are already allocated
+            self._predict = self.model
+        else:
+            # call the model through a traced function with a fixed input signature instead of
+            # model.predict, which sets up a data adapter and callbacks on every call
+            self._input_spec = tf.TensorSpec(shape=self.model.input_shape, dtype=self.model.inputs[0].dtype)
+            self._forward = tf.function(
+                lambda model_input: self.model(model_input, training=False),
+                input_signature=[self._input_spec]
+            )
+            self._predict = lambda model_input: self._forward(model_input).numpy()
+        self._predict(self._encode_input([[self._mappings["/"]] * SEQUENCE_LENGTH]))
+
+        # built on first use by incremental decoding
+        self._step_model = None
+        self._forward_step = None
+
+        # seconds taken by each step of the last generate_melody/generate_batch call, in
+        # total and split into model inference, sampling and mapping back to symbols
+        self.step_latencies = []
+        self.stage_latencies = {"inference": [], "sampling": [], "mapping": []}
+
+        # background thread for save_melody_async, started on first use
+        self._export_executor = None
+
+    def _encode_input(self, seeds):
+        """Turns a batch of int sequences (all of the same length) into model input"""
+        model_input = np.asarray(seeds, dtype="int32")
+        if not self._integer_input:
+            # one-hot encode the seeds
+            model_input = self._one_hot[model_input]
+
+        return model_input
 
-    def _sample_with_temperature(self, probabilites, temperature):
-        """Samples an index from a probability array reapplying softmax using temperature
-           return index (int): Selected output symbol
+    def _build_step_model(self):
         """
-        predictions = np.log(probabilites) / temperature
-        probabilites = np.exp(predictions) / np.sum(np.exp(predictions))
+        Rebuilds the trained LSTM model so that it takes the LSTM state (h, c) as an
+        extra input and returns the updated state next to the probabilities.
+        Every layer except the LSTM is shared with the trained model, the LSTM is
+        recreated from the trained layer's config with return_state=True and gets the
+        trained weights.
+        """
+        if self.model_type != "lstm":
+            raise ValueError("Incremental decoding is only supported for the unidirectional LSTM model")
+        if self.backend != "keras":
+            raise ValueError("Incremental decoding is only supported by the keras backend")
 
-        choices = range(len(probabilites)) # [0, 1, 2, 3]
-        index = np.random.choice(choices, p=probabilites)
+        layers = [layer for layer in self.model.layers if not isinstance(layer, keras.layers.InputLayer)]
+        lstm_index = next(i for i, layer in enumerate(layers) if isinstance(layer, keras.layers.LSTM))
+        lstm = layers[lstm_index]
 
-        return index
-    
-    def generate_melody(self, seed, num_steps, max_sequence_length=SEQUENCE_LENGTH, temperature=1.0):
+        inputs = keras.layers.Input(shape=self.model.input_shape[1:], dtype=self.model.inputs[0].dtype)
+        state_h = keras.layers.Input(shape=(lstm.units,))
+        state_c = keras.layers.Input(shape=(lstm.units,))
+
+        x = inputs
+        for layer in layers[:lstm_index]:
+            x = layer(x)
+
+        step_lstm = keras.layers.LSTM.from_config(
+            {**lstm.get_config(), "return_state": True, "return_sequences": False}
+        )
+        x, h, c = step_lstm(x, initial_state=[state_h, state_c])
+        step_lstm.set_weights(lstm.get_weights())
+
+        for layer in layers[lstm_index + 1:]:
+            x = layer(x)
+
+        return keras.Model([inputs, state_h, state_c], [x, h, c])
+
+    def _initial_state(self, batch_size):
+        """Builds the step model if needed and returns a zero LSTM state for batch_size sequences"""
+        if self._step_model is None:
+            self._step_model = self._build_step_model()
+            state_spec = tf.TensorSpec(shape=self._step_model.inputs[1].shape, dtype="float32")
+            self._forward_step = tf.function(
+                lambda tokens, h, c: self._step_model([tokens, h, c], training=False),
+                input_signature=[self._input_spec, state_spec, state_spec]
+            )
+            # trace it now so that the first generation step isn't slowed down
+            self._forward_step(self._encode_input([[self._mappings["/"]]]), *self._zero_state(1))
+
+        return self._zero_state(batch_size)
+
+    def _zero_state(self, batch_size):
+        units = self._step_model.inputs[1].shape[-1]
+        return [np.zeros((batch_size, units), dtype="float32")] * 2
+
+    def _predict_step(self, tokens, state):
+        """Feeds a batch of token sequences to the step model starting from state
+           return probabilities, state: next symbol distributions and the LSTM state after the tokens
+        """
+        probabilities, h, c = self._forward_step(self._encode_input(tokens), *state)
+        return probabilities.numpy(), [h.numpy(), c.numpy()]
+
+    def _reset_latencies(self):
+        self.step_latencies = []
+        self.stage_latencies = {stage: [] for stage in self.stage_latencies}
+
+    def _record_step(self, step_start, inference_end, sampling_end):
+        step_end = time.perf_counter()
+        self.step_latencies.append(step_end - step_start)
+        self.stage_latencies["inference"].append(inference_end - step_start)
+        self.stage_latencies["sampling"].append(sampling_end - inference_end)
+        self.stage_latencies["mapping"].append(step_end - sampling_end)
+
+    def generate_melody(self, seed, num_steps, max_sequence_length=SEQUENCE_LENGTH, temperature=1.0,
+                        incremental=False, top_k=None, top_p=None):
         """
         Generates a melody using either LSTM or Bi-LSTM model
+        :param top_k: sample only from the k most likely symbols
+        :param top_p: sample only from the most likely symbols that make up top_p of the probability
+        :param incremental: (LSTM only) run the model over the seed once and then feed one token
+            per step, carrying the LSTM state forward instead of re-running the whole window.
+            The state keeps the full history, so this matches the windowed path as long as the
+            window isn't truncated by max_sequence_length
         """
         seed = seed.split()
         melody = seed
@@ -48,23 +197,35 @@ class MelodyGenerator:
         # Map seed to integers
         seed = [self._mappings[symbol] for symbol in seed]
 
+        if incremental:
+            state = self._initial_state(1)
+            # prime the state with the same window the windowed path starts from
+            tokens = seed[-max_sequence_length:]
+
+        self._reset_latencies()
         for _ in range(num_steps):
+            step_start = time.perf_counter()
 
-            seed = seed[-max_sequence_length:]
+            if incremental:
+                probabilities, state = self._predict_step([tokens], state)
+            else:
+                seed = seed[-max_sequence_length:]
 
-            # one-hot encode the seed
-            onehot_seed = keras.utils.to_categorical(seed, num_classes=len(self._mappings))
-            onehot_seed = onehot_seed[np.newaxis, ...]
+                # make a prediction
+                probabilities = self._predict(self._encode_input([seed]))
+            inference_end = time.perf_counter()
 
-            # make a prediction
-            probabilities = self.model.predict(onehot_seed)[0]
-            output_int = self._sample_with_temperature(probabilities, temperature)
+            output_int = self._sampler(probabilities, temperature, top_k, top_p)[0]
+            sampling_end = time.perf_counter()
 
             # update seed
             seed.append(output_int)
+            tokens = [output_int]
 
             # map int to our encoding
-            output_symbol = [k for k, v in self._mappings.items() if v == output_int][0]
+            output_symbol = self._symbols[output_int]
+
+            self._record_step(step_start, inference_end, sampling_end)
 
             # check whether we're at the end of a melody
             if output_symbol == "/":
@@ -74,13 +235,90 @@ class MelodyGenerator:
             melody.append(output_symbol)
         return melody
 
-    def save_melody(self, melody, step_duration=0.25, format="midi", file_name=None):
+    def generate_batch(self, seeds, num_steps, temperatures=1.0, max_sequence_length=SEQUENCE_LENGTH,
+                       incremental=False, top_k=None, top_p=None):
+        """
+        Generates one melody per seed, advancing all of them together with a single
+        forward pass per step. Melodies that reach the end symbol "/" are masked out
+        and stop growing while the others carry on.
+        :param seeds: list of seed strings
+        :param temperatures: one temperature for all the melodies or one per seed
+        :param incremental, top_k, top_p: see generate_melody
+        return melodies (list): one list of symbols per seed
+        """
+        melodies = [seed.split() for seed in seeds]
+        temperatures = np.broadcast_to(np.asarray(temperatures, dtype="float64"), (len(seeds),))
+
+        # all the windows need the same length, so short seeds get extra start symbols
+        start_int = self._mappings["/"]
+        windows = []
+        for melody in melodies:
+            window = [self._mappings[symbol] for symbol in self._start_symbols + melody][-max_sequence_length:]
+            windows.append([start_int] * (max_sequence_length - len(window)) + window)
+        windows = np.array(windows)
+
+        if incremental:
+            state = self._initial_state(len(seeds))
+            tokens = windows
+
+        finished = np.zeros(len(seeds), dtype=bool)
+        self._reset_latencies()
+        for _ in range(num_steps):
+            step_start = time.perf_counter()
+
+            if incremental:
+                probabilities, state = self._predict_step(tokens, state)
+            else:
+                probabilities = self._predict(self._encode_input(windows))
+            inference_end = time.perf_counter()
+
+            output_ints = self._sampler(probabilities, temperatures, top_k, top_p)
+            sampling_end = time.perf_counter()
+
+            # update windows
+            windows = np.concatenate([windows[:, 1:], output_ints[:, np.newaxis]], axis=1)
+            tokens = output_ints[:, np.newaxis]
+
+            for i in np.flatnonzero(~finished):
+                output_symbol = self._symbols[output_ints[i]]
+
+                # check whether we're at the end of a melody
+                if output_symbol == "/":
+                    finished[i] = True
+                else:
+                    melodies[i].append(output_symbol)
+
+            self._record_step(step_start, inference_end, sampling_end)
+
+            if finished.all():
+                break
+
+        return melodies
+
+    def save_melody_async(self, melody, step_duration=0.25, format="midi", file_name=None, native=False):
+        """
+        Runs save_melody in a background thread so that the caller doesn't wait for the
+        file to be written
+        return future (Future): resolves once the file is written
+        """
+        if self._export_executor is None:
+            self._export_executor = ThreadPoolExecutor(max_workers=1)
+        return self._export_executor.submit(self.save_melody, list(melody), step_duration, format, file_name, native)
+
+    def save_melody(self, melody, step_duration=0.25, format="midi", file_name=None, native=False):
         """
         Converts the melody into a MIDI file
+        :param native: write the MIDI bytes directly with midi_writer instead of building
+            a music21 stream (same notes, much faster)
         """
         if file_name is None:
             file_name = f"{self.model_type}_output"
 
+        if native and format == "midi":
+            write_midi(melody, f"{file_name}.mid", step_duration)
+            print(f"Melody saved as {file_name}.mid")
+            return
+
         # Create a music21 stream
         stream = m21.stream.Stream()
 
@@ -134,6 +372,7 @@ def main():
             num_steps=500,
             temperature=0.3
         )
+        print(f"Average step latency: {np.mean(mg_lstm.step_latencies) * 1000:.2f} ms")
         mg_lstm.save_melody(lstm_melody, file_name="lstm_output")
     except Exception as e:
         print(f"Error generating LSTM melody: {e}")
@@ -147,6 +386,7 @@ def main():
             num_steps=500,
             temperature=0.3
         )
+        print(f"Average step latency: {np.mean(mg_bilstm.step_latencies) * 1000:.2f} ms")
         mg_bilstm.save_melody(bilstm_melody, file_name="bilstm_output")
     except Exception as e:
         print(f"Error generating Bi-LSTM melody: {e}")
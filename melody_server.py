@@ -0,0 +1,221 @@
+import json
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from melody_generator import MelodyGenerator
+from config import (SERVER_HOST, SERVER_PORT, SERVER_MAX_BATCH_SIZE, SERVER_BATCH_DELAY, SERVER_INCREMENTAL,
+                    SERVER_MAX_STEPS)
+
+MODEL_PATHS = {
+    "lstm": "lstm_model.h5",
+    "bilstm": "bilstm_model.h5"
+}
+
+
+class MicroBatcher:
+    def __init__(self, generator, max_batch_size=SERVER_MAX_BATCH_SIZE, max_delay=SERVER_BATCH_DELAY,
+                 incremental=SERVER_INCREMENTAL, max_steps=SERVER_MAX_STEPS):
+        """
+        Collects generate requests for one model and runs the ones that arrive within
+        max_delay seconds of each other as a single generate_batch call.
+        :param generator: MelodyGenerator that is kept loaded for the lifetime of the batcher
+        :param max_batch_size: maximum number of requests merged into one batch
+        :param max_delay: seconds to wait for more requests after the first one of a batch
+        :param max_steps: largest num_steps accepted, a batch holds the model until its longest request is done
+        :param incremental: (LSTM only) incremental decoding, see generate_melody. The window is
+            full of start symbols from the first step, so the LSTM state keeps more history than
+            the SEQUENCE_LENGTH window the model was trained on and melodies differ from the
+            windowed path used by generate_melody and compare_models
+        """
+        self.generator = generator
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.max_steps = max_steps
+        self.incremental = incremental and generator.model_type == "lstm"
+
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, seed, num_steps, temperature=1.0, top_k=None, top_p=None):
+        """Queues a request
+           return future (Future): resolves to the generated melody (list of symbols)
+        """
+        # checked here so that a bad request is a 400 for its client, not an error in the batch
+        if not isinstance(seed, str):
+            raise ValueError(f"seed must be a string of symbols, got {seed!r}")
+        unknown_symbols = [symbol for symbol in seed.split() if symbol not in self.generator._mappings]
+        if unknown_symbols:
+            raise ValueError(f"Unknown symbols in seed: {unknown_symbols}")
+
+        if isinstance(num_steps, bool) or not isinstance(num_steps, int) or not 1 <= num_steps <= self.max_steps:
+            raise ValueError(f"num_steps must be an integer between 1 and {self.max_steps}, got {num_steps!r}")
+        if isinstance(temperature, bool) or not isinstance(temperature, (int, float)) or not 0 < temperature < float("inf"):
+            raise ValueError(f"temperature must be a positive number, got {temperature!r}")
+        if top_k is not None:
+            if isinstance(top_k, bool) or not isinstance(top_k, (int, float)) or top_k != int(top_k) or top_k < 1:
+                raise ValueError(f"top_k must be a positive integer, got {top_k!r}")
+            top_k = int(top_k)
+        if top_p is not None:
+            if isinstance(top_p, bool) or not isinstance(top_p, (int, float)) or not 0 < top_p <= 1:
+                raise ValueError(f"top_p must be a number in (0, 1], got {top_p!r}")
+            top_p = float(top_p)
+
+        request = {
+            "seed": seed,
+            "num_steps": num_steps,
+            "temperature": float(temperature),
+            "top_k": top_k,
+            "top_p": top_p,
+            "future": Future()
+        }
+        self._queue.put(request)
+        return request["future"]
+
+    def _collect(self):
+        """Blocks for a first request, then gathers the ones arriving within max_delay"""
+        requests = [self._queue.get()]
+        deadline = time.monotonic() + self.max_delay
+
+        while len(requests) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                requests.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+
+        return requests
+
+    def _run(self):
+        while True:
+            requests = self._collect()
+
+            # an unexpected error fails this batch's requests instead of stopping the thread,
+            # which would leave every later request waiting forever
+            try:
+                # the sampler filters a whole batch the same way, so only merge matching filters
+                groups = {}
+                for request in requests:
+                    groups.setdefault((request["top_k"], request["top_p"]), []).append(request)
+
+                for (top_k, top_p), group in groups.items():
+                    self._generate(group, top_k, top_p)
+            except Exception as e:
+                for request in requests:
+                    if not request["future"].done():
+                        request["future"].set_exception(e)
+
+    def _generate(self, group, top_k, top_p):
+        try:
+            # generating past a request's num_steps doesn't change its first num_steps symbols
+            melodies = self.generator.generate_batch(
+                [request["seed"] for request in group],
+                num_steps=max(request["num_steps"] for request in group),
+                temperatures=[request["temperature"] for request in group],
+                incremental=self.incremental,
+                top_k=top_k,
+                top_p=top_p
+            )
+        except Exception as e:
+            for request in group:
+                request["future"].set_exception(e)
+            return
+
+        for request, melody in zip(group, melodies):
+            length = len(request["seed"].split()) + request["num_steps"]
+            request["future"].set_result(melody[:length])
+
+
+class MelodyRequestHandler(BaseHTTPRequestHandler):
+    """
+    POST /generate {"model": "lstm", "seed": "...", "num_steps": 500, "temperature": 0.3}
+    (optional "top_k" and "top_p") returns {"melody": [...]}.
+    GET /health returns the loaded models.
+    """
+
+    def do_GET(self):
+        if self.path != "/health":
+            self._send_json(404, {"error": f"Unknown path {self.path}"})
+            return
+        self._send_json(200, {"models": sorted(self.server.batchers)})
+
+    def do_POST(self):
+        if self.path != "/generate":
+            self._send_json(404, {"error": f"Unknown path {self.path}"})
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length))
+            if not isinstance(request, dict):
+                raise ValueError("The request body must be a JSON object")
+            model_type = request.get("model", "lstm")
+            if model_type not in self.server.batchers:
+                raise ValueError(f"Model '{model_type}' is not loaded")
+
+            future = self.server.batchers[model_type].submit(
+                seed=request["seed"],
+                num_steps=request["num_steps"],
+                temperature=request.get("temperature", 1.0),
+                top_k=request.get("top_k"),
+                top_p=request.get("top_p")
+            )
+        except (ValueError, KeyError, TypeError) as e:
+            self._send_json(400, {"error": str(e)})
+            return
+
+        try:
+            melody = future.result()
+        except Exception as e:
+            self._send_json(500, {"error": str(e)})
+            return
+
+        self._send_json(200, {"melody": melody})
+
+    def _send_json(self, status, body):
+        body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def create_server(model_paths=MODEL_PATHS, host=SERVER_HOST, port=SERVER_PORT,
+                  max_batch_size=SERVER_MAX_BATCH_SIZE, max_delay=SERVER_BATCH_DELAY, incremental=SERVER_INCREMENTAL,
+                  max_steps=SERVER_MAX_STEPS):
+    """Loads every model that exists once and returns an HTTP server that keeps them warm"""
+    batchers = {}
+    for model_type, model_path in model_paths.items():
+        if not os.path.exists(model_path):
+            print(f"Skipping {model_type} model, {model_path} not found")
+            continue
+        print(f"Loading {model_type} model from {model_path}...")
+        batchers[model_type] = MicroBatcher(MelodyGenerator(model_path, model_type), max_batch_size, max_delay,
+                                            incremental, max_steps)
+
+    if not batchers:
+        raise FileNotFoundError("No trained models found, run train_lstm.py or train_bilstm.py first")
+
+    server = ThreadingHTTPServer((host, port), MelodyRequestHandler)
+    server.batchers = batchers
+    return server
+
+
+def main():
+    server = create_server()
+    print(f"Serving melodies on http://{SERVER_HOST}:{SERVER_PORT}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+import struct
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+# same defaults as the files music21 writes
+TICKS_PER_QUARTER = 10080
+TEMPO = 500000  # microseconds per quarter note, 120 bpm
+VELOCITY = 90
+
+_CONDUCTOR_TRACK_EVENTS = (
+    b"\x00\xff\x51\x03" + TEMPO.to_bytes(3, "big")  # set tempo
+    + b"\x00\xff\x58\x04\x04\x02\x18\x08"  # 4/4 time signature
+    + b"\x00\xff\x2f\x00"  # end of track
+)
+
+
+def melody_to_events(melody, step_duration=0.25):
+    """
+    Run-length pass over the time series encoding, giving the same events as save_melody:
+    every symbol other than "_" starts an event lasting until the next one, the last
+    event loses its last step (and is dropped if that leaves nothing) and prolongation
+    signs before the first symbol are added to the first event.
+    return symbols, durations (np.ndarray): event symbols and quarter lengths
+    """
+    symbols = np.asarray(melody, dtype=str)
+    starts = np.flatnonzero(symbols != "_")
+    if len(starts) == 0:
+        return symbols[:0], np.zeros(0)
+
+    steps = np.diff(np.append(starts, len(symbols)))
+    steps[-1] -= 1
+    keep = steps > 0
+    steps[0] += starts[0]
+
+    return symbols[starts][keep], steps[keep] * step_duration
+
+def _variable_length_quantities(values):
+    """
+    Encodes an array of delta times as MIDI variable length quantities (up to 4 bytes)
+    return groups, used: (n, 4) bytes and which of them belong to each quantity
+    """
+    values = np.asarray(values, dtype=np.int64)
+    shifts = np.array([21, 14, 7, 0])
+    groups = ((values[:, np.newaxis] >> shifts) & 0x7F).astype(np.uint8)
+
+    num_bytes = 1 + (values >= 1 << 7) + (values >= 1 << 14) + (values >= 1 << 21)
+    used = np.arange(4) >= 4 - num_bytes[:, np.newaxis]
+
+    # continuation bit on every used byte but the last one
+    groups[:, :3] |= np.where(used[:, :3], 0x80, 0).astype(np.uint8)
+    return groups, used
+
+def melody_track(melody, step_duration=0.25, channel=0):
+    """Builds the MTrk chunk of a melody, all its note events written with one array pass"""
+    symbols, durations = melody_to_events(melody, step_duration)
+    ticks = np.rint(durations * TICKS_PER_QUARTER).astype(np.int64)
+
+    is_note = symbols != "r"
+    pitches = symbols[is_note].astype(np.int64)
+
+    # rests only shift the next note on, a trailing rest delays the end of the track
+    start_ticks = np.cumsum(ticks) - ticks
+    note_on_ticks = start_ticks[is_note]
+    note_off_ticks = note_on_ticks + ticks[is_note]
+    previous_off_ticks = np.concatenate([[0], note_off_ticks[:-1]])
+    end_of_track_delta = int(np.sum(ticks)) - (int(note_off_ticks[-1]) if len(note_off_ticks) else 0)
+
+    # one row per note: delta, note on, delta, note off; unused delta bytes are masked out
+    on_groups, on_used = _variable_length_quantities(note_on_ticks - previous_off_ticks)
+    off_groups, off_used = _variable_length_quantities(ticks[is_note])
+    rows = np.zeros((len(pitches), 14), dtype=np.uint8)
+    used = np.ones((len(pitches), 14), dtype=bool)
+    rows[:, 0:4], used[:, 0:4] = on_groups, on_used
+    rows[:, 4:7] = np.column_stack([np.full(len(pitches), 0x90 | channel), pitches, np.full(len(pitches), VELOCITY)])
+    rows[:, 7:11], used[:, 7:11] = off_groups, off_used
+    rows[:, 11:14] = np.column_stack([np.full(len(pitches), 0x80 | channel), pitches, np.zeros(len(pitches))])
+
+    end_groups, end_used = _variable_length_quantities([end_of_track_delta])
+    events = b"".join([
+        b"\x00\xff\x03\x00",  # empty track name
+        bytes([0x00, 0xE0 | channel, 0x00, 0x40]),  # centred pitch bend
+        rows[used].tobytes(),
+        end_groups[end_used].tobytes(),
+        b"\xff\x2f\x00"  # end of track
+    ])
+    return b"MTrk" + struct.pack(">I", len(events)) + events
+
+def melodies_to_midi_bytes(melodies, step_duration=0.25):
+    """Standard MIDI File (format 1) with a conductor track and one track per melody"""
+    header = b"MThd" + struct.pack(">IHHH", 6, 1, len(melodies) + 1, TICKS_PER_QUARTER)
+    conductor = b"MTrk" + struct.pack(">I", len(_CONDUCTOR_TRACK_EVENTS)) + _CONDUCTOR_TRACK_EVENTS
+
+    return b"".join([header, conductor] + [melody_track(melody, step_duration) for melody in melodies])
+
+def write_midi(melody, file_path, step_duration=0.25):
+    """Writes a melody encoded as a time series straight to a MIDI file"""
+    with open(file_path, "wb") as fp:
+        fp.write(melodies_to_midi_bytes([melody], step_duration))
+
+def write_midi_files(melodies, file_paths, step_duration=0.25, num_threads=8):
+    """Bulk export: one MIDI file per melody, written from a thread pool"""
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        list(executor.map(lambda args: write_midi(*args, step_duration), zip(melodies, file_paths)))
+
+def write_multitrack_midi(melodies, file_path, step_duration=0.25):
+    """Bulk export: all the melodies as the tracks of a single MIDI file"""
+    with open(file_path, "wb") as fp:
+        fp.write(melodies_to_midi_bytes(melodies, step_duration))
@@ -1,18 +1,36 @@
 import os
 import json
+import hashlib
+import time
+from functools import partial
 import numpy as np
 import music21 as m21
+import tensorflow as tf
 import tensorflow.keras as keras
-from config import KERN_DATASET_PATH,SINGLE_FILE_DATASET,MAPPING_PATH,SEQUENCE_LENGTH,SAVE_DIR,ACCEPTABLE_DURATIONS
+from multiprocessing import Pool
+from config import KERN_DATASET_PATH,SINGLE_FILE_DATASET,INT_DATASET,MAPPING_PATH,SEQUENCE_LENGTH,SAVE_DIR,ACCEPTABLE_DURATIONS,NUM_WORKERS,TIME_STEP,CACHE_DIR,KERN_FAST_PATH
+from kern_parser import encode_kern,UnsupportedKernError
+from vocabulary import count_symbols,build_vocabulary,save_vocabulary
 
-def load_songs_in_kern(dataset_path):
-    songs=[]
-    # go through all the files in the dataset and load them with music21
+# bump when a change to the code alters the encoded songs, so that cached songs get re-encoded
+PREPROCESS_VERSION = 1
+
+def find_kern_files(dataset_path):
+    """Returns the paths of all the kern files in the dataset, in os.walk order"""
+    kern_files=[]
     for path, subdirs,files in os.walk(dataset_path):
         for file in files:
             if file[-3:] == "krn":
-                song = m21.converter.parse(os.path.join(path,file))
-                songs.append(song)
+                kern_files.append(os.path.join(path,file))
+
+    return kern_files
+
+def load_songs_in_kern(dataset_path):
+    songs=[]
+    # go through all the files in the dataset and load them with music21
+    for file_path in find_kern_files(dataset_path):
+        song = m21.converter.parse(file_path)
+        songs.append(song)
     
     return songs
 
@@ -23,12 +41,8 @@ def has_acceptable_durations(song , acceptable_durations):
     
     return True
 
-def transpose(song):
-    """Transposes song to C maj/A min
-    return transposed_song (m21 stream):
-    """
-
-    # get key from the song
+def song_key(song):
+    """Key given in the first measure of the song, estimated with music21 if there is none"""
     parts = song.getElementsByClass(m21.stream.Part)
     measures_part0 = parts[0].getElementsByClass(m21.stream.Measure)
     key = measures_part0[0][4]
@@ -36,11 +50,20 @@ def transpose(song):
     # estimate key using music21
     if not isinstance(key, m21.key.Key):
         key = song.analyze("key")
+    return key
 
+def transposition_interval(key):
+    """Interval that takes key to C maj/A min"""
     if key.mode == "major":
-        interval = m21.interval.Interval(key.tonic, m21.pitch.Pitch("C"))
+        return m21.interval.Interval(key.tonic, m21.pitch.Pitch("C"))
     elif key.mode == "minor":
-        interval = m21.interval.Interval(key.tonic, m21.pitch.Pitch("A"))
+        return m21.interval.Interval(key.tonic, m21.pitch.Pitch("A"))
+
+def transpose(song):
+    """Transposes song to C maj/A min
+    return transposed_song (m21 stream):
+    """
+    interval = transposition_interval(song_key(song))
 
     # transpose song by calculated interval
     tranposed_song = song.transpose(interval)
@@ -71,65 +94,282 @@ def load(file_path):
         song = fp.read()
     return song
 
+def load_dataset_index(file_dataset_path,sequence_length):
+    """Where every song of the previous single file dataset came from, kept next to it
+    (file_dataset -> file_dataset.json)
+    return index (dict): relative song path -> [size, mtime_ns, start, end] of the song in the
+        single file dataset; empty if there is no previous dataset built with sequence_length
+    """
+    index_path = file_dataset_path + ".json"
+    if not os.path.exists(file_dataset_path) or not os.path.exists(index_path):
+        return {}
+
+    with open(index_path,"r") as fp:
+        index = json.load(fp)
+    return index["songs"] if index["sequence_length"] == sequence_length else {}
+
 def create_single_file_dataset(dataset_path,file_dataset_path,sequence_length):
+    """Joins the encoded songs of dataset_path with sequence_length delimiters between them.
+    Incremental: songs whose file has the same size and modification time as in the previous
+    build are copied from the previous single file dataset, only new or changed ones are read
+    """
     new_song_delimiter = "/ " * sequence_length
-    songs = ""
-
-    # load encoded songs and add delimiters
+    previous_index = load_dataset_index(file_dataset_path,sequence_length)
+    previous_songs = None
+    if previous_index:
+        with open(file_dataset_path,"r") as fp:
+            previous_songs = fp.read()
+
+    songs = []
+    index = {}
+    position = 0
+    num_read = 0
+
+    # load encoded songs and add delimiters, joined once at the end (linear in the dataset size)
     for path,_,files in os.walk(dataset_path):
         for file in files:
             file_path = os.path.join(path,file)
-            song = load(file_path)
-            songs += song + " " + new_song_delimiter
-    songs = songs[:-1]
+            relative_path = os.path.relpath(file_path,dataset_path)
+            stat = os.stat(file_path)
+            previous = previous_index.get(relative_path)
+            if previous and previous[:2] == [stat.st_size,stat.st_mtime_ns]:
+                song = previous_songs[previous[2]:previous[3]]
+            else:
+                song = load(file_path)
+                num_read += 1
+
+            index[relative_path] = [stat.st_size,stat.st_mtime_ns,position,position + len(song)]
+            songs.append(song + " " + new_song_delimiter)
+            position += len(songs[-1])
+    songs = "".join(songs)[:-1]
+    print(f"Single file dataset: {len(index) - num_read} songs reused, {num_read} read")
 
     #save strings that contain all the dataset
     with open(file_dataset_path,"w") as fp:
         fp.write(songs)
+    with open(file_dataset_path + ".json","w") as fp:
+        json.dump({"sequence_length":sequence_length,"songs":index},fp)
 
     return songs
 
 def create_mapping(songs,mapping_path):
-    mappings = {}
+    """Builds the vocabulary (sorted symbols with their counts) of the dataset and saves it
+    with the mapping derived from it, so ids don't change between runs
+    """
+    symbol_counts = count_symbols([songs])
+    save_vocabulary(build_vocabulary(symbol_counts),mapping_path=mapping_path)
 
-    #identify the vocabulary
-    songs = songs.split()
-    vocabulary = list(set(songs))
+def encode_events(events,semitones,time_step=0.25):
+    """encode_song for the flattened notes and rests of a song, transposing the notes by
+    adding semitones to their MIDI numbers instead of transposing a copy of the song
+    """
+    encoded_song=[]
+    for event in events:
+        if isinstance(event,m21.note.Note):
+            symbol = event.pitch.midi + semitones
+        elif isinstance(event,m21.note.Rest):
+            symbol = "r"
 
-    #create mappings
-    for i,symbol in enumerate(vocabulary):
-        mappings[symbol] = i
+        encoded_song.append(symbol)
+        encoded_song.extend(["_"] * (int(event.duration.quarterLength/time_step) - 1))
 
-    #save the vocabulary to a json file
-    with open(mapping_path ,"w") as fp:
-        json.dump(mappings,fp,indent=4)
+    return " ".join(map(str,encoded_song))
 
-def preprocess(dataset_path):
+def add_time(timings,stage,start_time):
+    """Adds the time since start_time to the stage counter; return the current time"""
+    now = time.perf_counter()
+    if timings is not None:
+        timings[stage] = timings.get(stage,0.0) + now - start_time
+    return now
 
-    # load the folk songs
-    songs = load_songs_in_kern(dataset_path)
+def process_song(song,timings=None,key_cache_path=None):
+    """Filters, transposes and encodes a single song in one pass over its notes and rests:
+    same result as has_acceptable_durations, transpose and encode_song
+    :param timings: dict of seconds per stage, updated in place
+    :param key_cache_path: json file caching the key when it has to be estimated
+    return encoded_song (str): None if the song has non-acceptable durations
+    """
+    start_time = time.perf_counter()
+    events = list(song.flatten().notesAndRests)
+
+    # filter out songs that have non-acceptable durations
+    acceptable = all(event.duration.quarterLength in ACCEPTABLE_DURATIONS for event in events)
+    start_time = add_time(timings,"filter",start_time)
+    if not acceptable:
+        return None
+
+    # transpose songs to Cmaj/Amin
+    key = load_cached_key(key_cache_path) if key_cache_path else None
+    if key is None:
+        key = song_key(song)
+        if key_cache_path:
+            save_cached_key(key_cache_path,key)
+    semitones = transposition_interval(key).semitones
+    start_time = add_time(timings,"key",start_time)
+
+    # encode songs with music time series representation
+    encoded_song = encode_events(events,semitones,TIME_STEP)
+    add_time(timings,"encode",start_time)
+    return encoded_song
+
+def process_kern_file(file_path,fast_path=KERN_FAST_PATH,cache_dir=CACHE_DIR):
+    """Parses a kern file and runs it through process_song. Used by the worker processes,
+    so that only the encoded string and the stage timings are sent back to the parent process.
+    With fast_path, files in the subset handled by kern_parser skip music21 entirely
+    return encoded_song, timings
+    """
+    timings = {}
+    start_time = time.perf_counter()
+    with open(file_path,"rb") as fp:
+        content = fp.read()
+    start_time = add_time(timings,"read",start_time)
+
+    if fast_path:
+        try:
+            encoded_song = encode_kern(content.decode("latin-1"),ACCEPTABLE_DURATIONS,TIME_STEP)
+            add_time(timings,"fast path",start_time)
+            return encoded_song,timings
+        except UnsupportedKernError:
+            start_time = add_time(timings,"fast path",start_time)
+
+    song = m21.converter.parse(file_path)
+    add_time(timings,"parse",start_time)
+
+    key_cache_path = os.path.join(cache_dir,hashlib.sha256(content).hexdigest() + ".key.json") if cache_dir else None
+    return process_song(song,timings,key_cache_path),timings
+
+def song_cache_key(file_path):
+    """Key of the encoded song in the cache: hash of the kern file content plus
+    everything else that changes the output of process_song
+    """
+    hasher = hashlib.sha256()
+    with open(file_path,"rb") as fp:
+        hasher.update(fp.read())
+
+    settings = [[float(d) for d in ACCEPTABLE_DURATIONS],TIME_STEP,PREPROCESS_VERSION]
+    hasher.update(json.dumps(settings).encode())
+    return hasher.hexdigest()
+
+def load_cached_song(cache_dir,key):
+    """return (found, encoded_song): encoded_song is None for songs that were filtered out"""
+    cache_path = os.path.join(cache_dir,key + ".json")
+    if not os.path.exists(cache_path):
+        return False,None
+
+    with open(cache_path,"r") as fp:
+        return True,json.load(fp)["encoded_song"]
+
+def save_cached_song(cache_dir,key,encoded_song):
+    os.makedirs(cache_dir,exist_ok=True)
+    cache_path = os.path.join(cache_dir,key + ".json")
+
+    # write to a temporary file first so that concurrent runs never see half written entries
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    with open(tmp_path,"w") as fp:
+        json.dump({"encoded_song": encoded_song},fp)
+    os.replace(tmp_path,cache_path)
+
+def load_cached_key(key_cache_path):
+    """return key (m21.key.Key): None if the key of the file isn't cached"""
+    if not os.path.exists(key_cache_path):
+        return None
+
+    with open(key_cache_path,"r") as fp:
+        key = json.load(fp)
+    return m21.key.Key(key["tonic"],key["mode"])
+
+def save_cached_key(key_cache_path,key):
+    os.makedirs(os.path.dirname(key_cache_path) or ".",exist_ok=True)
+    tmp_path = key_cache_path + f".{os.getpid()}.tmp"
+    with open(tmp_path,"w") as fp:
+        json.dump({"tonic":key.tonic.name,"mode":key.mode},fp)
+    os.replace(tmp_path,key_cache_path)
+
+def encode_kern_files(kern_files,num_workers=NUM_WORKERS,cache_dir=CACHE_DIR,chunksize=8,timings=None):
+    """Yields the encoded song (or None if filtered out) of every kern file, in file order.
+    Songs found in the cache are not parsed again, the others are encoded in this process
+    or, if num_workers > 1, streamed to a process pool
+    :param timings: dict of seconds per stage, updated in place (summed over the workers)
+    """
+    start_time = time.perf_counter()
+    keys = []
+    cached_songs = []
+    misses = []
+    for file_path in kern_files:
+        key = song_cache_key(file_path) if cache_dir else None
+        found,encoded_song = load_cached_song(cache_dir,key) if key else (False,None)
+        if not found:
+            misses.append(file_path)
+        keys.append(key)
+        cached_songs.append((found,encoded_song))
+    add_time(timings,"cache lookup",start_time)
+
+    process = partial(process_kern_file,cache_dir=cache_dir)
+    if num_workers > 1 and misses:
+        pool = Pool(num_workers)
+        results = pool.imap(process,misses,chunksize=chunksize)
+    else:
+        pool = None
+        results = map(process,misses)
+
+    try:
+        for key,(found,encoded_song) in zip(keys,cached_songs):
+            if not found:
+                encoded_song,song_timings = next(results)
+                if timings is not None:
+                    for stage,seconds in song_timings.items():
+                        timings[stage] = timings.get(stage,0.0) + seconds
+                if key:
+                    save_cached_song(cache_dir,key,encoded_song)
+            yield encoded_song
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+def save_encoded_song(encoded_song,i):
+    """Writes the song to SAVE_DIR/i unless the file already holds it, so that unchanged
+    songs keep their modification time and create_single_file_dataset can reuse them
+    """
+    save_path = os.path.join(SAVE_DIR,str(i))
+    if os.path.exists(save_path) and os.path.getsize(save_path) == len(encoded_song) and load(save_path) == encoded_song:
+        return
+    with open(save_path,"w") as fp:
+        fp.write(encoded_song)
+
+def print_timings(timings):
+    for stage,seconds in timings.items():
+        print(f"{stage:>14}: {seconds:8.2f} s")
+
+def preprocess(dataset_path,num_workers=NUM_WORKERS,cache_dir=CACHE_DIR):
+    """Encodes all the songs of the dataset and saves them in SAVE_DIR
+    :param num_workers: number of worker processes; 1 runs everything in this process
+    :param cache_dir: directory of the encoded songs cache; None disables the cache
+    return timings (dict): seconds spent in each stage
+    """
+    kern_files = find_kern_files(dataset_path)
+    timings = {}
 
-    for i,song in enumerate(songs):
-        # filter out songs that have non-acceptable durations
-        if not has_acceptable_durations(song,ACCEPTABLE_DURATIONS):
+    for i,encoded_song in enumerate(encode_kern_files(kern_files,num_workers,cache_dir,timings=timings)):
+        if encoded_song is None:
             continue
 
-        # transpose songs to Cmaj/Amin
-        song = transpose(song)
+        # save songs to text file
+        start_time = time.perf_counter()
+        save_encoded_song(encoded_song,i)
+        add_time(timings,"save",start_time)
 
-        # encode songs with music time series representation
-        encoded_song = encode_song(song)
+    print_timings(timings)
+    return timings
 
-        # save songs to text file
-        save_path = os.path.join(SAVE_DIR,str(i))
-        with open(save_path,"w") as fp:
-            fp.write(encoded_song)
+def load_mappings(mapping_path=MAPPING_PATH):
+    with open(mapping_path,"r") as fp:
+        mappings = json.load(fp)
+    return mappings
 
 def convert_songs_to_int(songs):
     int_songs = []
     #load mappings
-    with open(MAPPING_PATH,"r") as fp:
-        mappings = json.load(fp)
+    mappings = load_mappings()
 
     #cast songs string to a list
     songs = songs.split()
@@ -140,26 +380,89 @@ def convert_songs_to_int(songs):
 
     return int_songs
 
-def generate_training_sequences(sequence_length):
-    X = []
-    y = []
+def create_int_dataset(songs,int_dataset_path):
+    """Saves the songs as a .npy array of integer tokens (uint8, or uint16 for vocabularies
+    bigger than 256 symbols). The vocabulary itself stays in mapping.json
+    """
+    dtype = np.uint8 if len(load_mappings()) <= 256 else np.uint16
+    int_songs = np.array(convert_songs_to_int(songs),dtype=dtype)
+    np.save(int_dataset_path,int_songs)
+
+def load_int_dataset(int_dataset_path=INT_DATASET):
+    """Memory maps the integer token dataset, nothing is read until it's accessed
+    return int_songs (np.memmap):
+    """
+    return np.load(int_dataset_path,mmap_mode="r")
 
-    # load songs and convert them to int
-    songs = load(SINGLE_FILE_DATASET)
-    int_songs = convert_songs_to_int(songs)
+def generate_training_sequences(sequence_length,one_hot=True,timings=None):
+    """:param timings: dict of seconds per stage ("sequences", "one-hot"), updated in place"""
+    start_time = time.perf_counter()
+    # load songs as integer tokens
+    int_songs = load_int_dataset()
 
     # generate the training sequences
+    X = np.lib.stride_tricks.sliding_window_view(int_songs[:-1],sequence_length)
+    y = np.array(int_songs[sequence_length:])
+    start_time = add_time(timings,"sequences",start_time)
+
+    # one hot encode the sequences, embedding models take the integer tokens as they are
+    if one_hot:
+        vocabulary_size = len(load_mappings())
+        X = keras.utils.to_categorical(X,num_classes=vocabulary_size)
+    else:
+        X = np.array(X)
+    add_time(timings,"one-hot",start_time)
+
+    return X,y
+
+
+def _window_batches(int_songs,indices,sequence_length,batch_size,rng=None):
+    """Yields (windows, next symbols) batches for the given window start indices.
+    Indices are reshuffled on every pass if rng is given
+    """
+    if rng is not None:
+        indices = rng.permutation(indices)
+    offsets = np.arange(sequence_length)
+
+    for start in range(0,len(indices),batch_size):
+        # sorting the batch doesn't change the gradient, but reads the memmap in order
+        batch = np.sort(indices[start:start+batch_size])
+        yield int_songs[batch[:,np.newaxis] + offsets],int_songs[batch + sequence_length]
+
+def create_training_datasets(sequence_length,batch_size,validation_split=0.2,random_state=42,one_hot=True):
+    """Streaming alternative to generate_training_sequences: batches of windows are sliced
+    from the memory mapped token dataset on the fly and one hot encoded inside the graph,
+    so the N x sequence_length x vocabulary_size tensor is never built.
+    Windows are split into training and validation sets by index
+    return train_dataset, validation_dataset (tf.data.Dataset):
+    """
+    int_songs = load_int_dataset()
+    vocabulary_size = len(load_mappings())
+
     num_sequences = len(int_songs) - sequence_length
-    for i in range(num_sequences):
-        X.append(int_songs[i:i+sequence_length])
-        y.append(int_songs[i+sequence_length])
+    indices = np.random.default_rng(random_state).permutation(num_sequences)
+    num_validation = int(num_sequences * validation_split)
+    train_indices,validation_indices = indices[num_validation:],indices[:num_validation]
 
-    # one hot encode the sequences
-    vocabulary_size = len(set(int_songs))
-    X = keras.utils.to_categorical(X,num_classes=vocabulary_size)
-    y = np.array(y)
+    output_signature = (
+        tf.TensorSpec(shape=(None,sequence_length),dtype=int_songs.dtype),
+        tf.TensorSpec(shape=(None,),dtype=int_songs.dtype)
+    )
 
-    return X,y
+    def make_dataset(indices,rng):
+        dataset = tf.data.Dataset.from_generator(
+            lambda: _window_batches(int_songs,indices,sequence_length,batch_size,rng),
+            output_signature=output_signature
+        )
+        num_batches = -(-len(indices) // batch_size)
+        dataset = dataset.apply(tf.data.experimental.assert_cardinality(num_batches))
+        if one_hot:
+            dataset = dataset.map(lambda X,y: (tf.one_hot(tf.cast(X,tf.int32),vocabulary_size),y))
+        return dataset.prefetch(tf.data.AUTOTUNE)
+
+    train_dataset = make_dataset(train_indices,np.random.default_rng(random_state))
+    validation_dataset = make_dataset(validation_indices,None)
+    return train_dataset,validation_dataset
 
 
 
@@ -167,6 +470,7 @@ def main():
     preprocess(KERN_DATASET_PATH)
     songs = create_single_file_dataset(SAVE_DIR,SINGLE_FILE_DATASET,SEQUENCE_LENGTH)
     create_mapping(songs,MAPPING_PATH)
+    create_int_dataset(songs,INT_DATASET)
 
 if __name__== "__main__":
     main()
\ No newline at end of file
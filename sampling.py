@@ -0,0 +1,97 @@
+import numpy as np
+
+
+class Sampler:
+    """
+    Samples the next symbol for a whole batch of probability distributions at once.
+    Temperature is reapplied as in a softmax, then the rows are optionally filtered with
+    top-k and/or top-p (nucleus) filtering and one index per row is drawn by inverse
+    transform sampling on the cumulative distribution.
+    Work buffers are allocated for the first batch shape and reused afterwards, so
+    sampling without top-k/top-p doesn't allocate inside a generation loop.
+    """
+
+    def __init__(self, rng=None):
+        """
+        :param rng: numpy.random.Generator or seed; pass one for reproducible output
+        """
+        self.rng = np.random.default_rng(rng)
+        self._shape = None
+
+    def _allocate(self, shape):
+        self._shape = shape
+        self._weights = np.empty(shape, dtype="float64")
+        self._cumulative = np.empty(shape, dtype="float64")
+        self._below = np.empty(shape, dtype=bool)
+        self._row = np.empty((shape[0], 1), dtype="float64")
+        self._thresholds = np.empty(shape[0], dtype="float64")
+        self._indices = np.empty(shape[0], dtype="int64")
+
+    def __call__(self, probabilities, temperatures=1.0, top_k=None, top_p=None):
+        """
+        :param probabilities: (batch, vocabulary) array of probabilities
+        :param temperatures: one temperature for all the rows or one per row (all > 0)
+        :param top_k: keep only the k most likely symbols of each row
+        :param top_p: keep only the most likely symbols whose probabilities add up to top_p
+        return indices (np.ndarray): one sampled symbol per row
+        """
+        # log(p) / 0 is nan, which would silently pick index 0 for every row
+        if not np.all(np.asarray(temperatures) > 0):
+            raise ValueError(f"Temperatures must be positive, got {temperatures}")
+
+        if probabilities.shape != self._shape:
+            self._allocate(probabilities.shape)
+        weights = self._weights
+
+        # reapply softmax using temperature, shifted by the row maximum for stability
+        with np.errstate(divide="ignore"):
+            np.log(probabilities, out=weights)
+        if np.ndim(temperatures) == 0:
+            np.divide(weights, temperatures, out=weights)
+        else:
+            np.divide(weights, np.reshape(temperatures, (-1, 1)), out=weights)
+        np.max(weights, axis=1, keepdims=True, out=self._row)
+        np.subtract(weights, self._row, out=weights)
+        np.exp(weights, out=weights)
+
+        if top_k is not None and top_k < weights.shape[1]:
+            top_k_filter(weights, top_k)
+        if top_p is not None and top_p < 1.0:
+            top_p_filter(weights, top_p)
+
+        # inverse transform sampling on the unnormalised cumulative distribution
+        np.cumsum(weights, axis=1, out=self._cumulative)
+        self.rng.random(out=self._thresholds)
+        np.multiply(self._thresholds, self._cumulative[:, -1], out=self._thresholds)
+        np.less(self._cumulative, self._thresholds[:, np.newaxis], out=self._below)
+        np.sum(self._below, axis=1, out=self._indices)
+        np.minimum(self._indices, weights.shape[1] - 1, out=self._indices)
+
+        return self._indices.copy()
+
+
+def top_k_filter(weights, k):
+    """Zeroes, in place, everything but the k largest weights of each row"""
+    kth_largest = -np.partition(-weights, k - 1, axis=1)[:, k - 1:k]
+    weights[weights < kth_largest] = 0.0
+    return weights
+
+
+def top_p_filter(weights, p):
+    """Zeroes, in place, the least likely weights of each row, keeping the smallest set
+    of symbols whose share of the row total reaches p (at least one per row)"""
+    order = np.argsort(-weights, axis=1)
+    sorted_weights = np.take_along_axis(weights, order, axis=1)
+    cumulative = np.cumsum(sorted_weights, axis=1)
+
+    # a symbol is kept if the symbols before it don't already reach p
+    keep = (cumulative - sorted_weights) < p * cumulative[:, -1:]
+    np.put_along_axis(weights, order, np.where(keep, sorted_weights, 0.0), axis=1)
+    return weights
+
+
+def sample(probabilities, temperatures=1.0, top_k=None, top_p=None, rng=None):
+    """One-off version of Sampler for a single (vocabulary,) or (batch, vocabulary) array"""
+    probabilities = np.asarray(probabilities)
+    indices = Sampler(rng)(np.atleast_2d(probabilities), temperatures, top_k, top_p)
+    return indices[0] if probabilities.ndim == 1 else indices
@@ -0,0 +1,140 @@
+import os
+import sys
+import numpy as np
+import tensorflow as tf
+import tensorflow.keras as keras
+from preprocess import load_int_dataset
+from training_runner import MODEL_PATHS
+from tflite_model import TFLiteModel
+from config import (INT_DATASET, SEQUENCE_LENGTH, TFLITE_QUANTIZATION, TFLITE_BATCH_SIZE,
+                    TFLITE_VALIDATION_WINDOWS, TFLITE_MAX_KL)
+
+
+def tflite_path(model_path):
+    """lstm_model.h5 -> lstm_model.tflite, which shares lstm_model.vocab.json with the Keras model"""
+    return os.path.splitext(model_path)[0] + ".tflite"
+
+def _unrolled(layer):
+    """Clones a layer, unrolling LSTMs: the converter then emits plain ops instead of a while
+    loop, which the interpreter runs faster"""
+    config = layer.get_config()
+    if isinstance(layer, keras.layers.LSTM):
+        config["unroll"] = True
+    elif isinstance(layer, keras.layers.Bidirectional):
+        config["layer"]["config"]["unroll"] = True
+        if config.get("backward_layer"):
+            config["backward_layer"]["config"]["unroll"] = True
+    return layer.__class__.from_config(config)
+
+def fixed_shape_model(model, batch_size=TFLITE_BATCH_SIZE, sequence_length=SEQUENCE_LENGTH):
+    """Copy of a trained model with a fixed input shape and unrolled LSTMs, ready to convert"""
+    inputs = keras.Input(batch_shape=(batch_size, sequence_length) + tuple(model.input_shape[2:]),
+                         dtype=model.inputs[0].dtype)
+    fixed = keras.models.clone_model(model, input_tensors=inputs, clone_function=_unrolled)
+    fixed.set_weights(model.get_weights())
+    return fixed
+
+def sample_windows(num_windows, sequence_length, num_symbols, rng):
+    """
+    Random windows of the token dataset, the inputs the model sees when generating.
+    Random tokens if there is no dataset or it was encoded with a bigger vocabulary than the model's
+    return windows (np.ndarray): (num_windows, sequence_length) int tokens
+    """
+    if os.path.exists(INT_DATASET):
+        int_songs = load_int_dataset()
+        if len(int_songs) > sequence_length and int(int_songs.max()) < num_symbols:
+            starts = rng.integers(0, len(int_songs) - sequence_length, num_windows)
+            return np.stack([int_songs[start:start + sequence_length] for start in starts]).astype("int32")
+
+    print("Using random windows, the token dataset doesn't match the model")
+    return rng.integers(0, num_symbols, (num_windows, sequence_length)).astype("int32")
+
+def encode_windows(windows, model_input_shape, num_symbols):
+    """One-hot windows for one-hot models, integer tokens for embedding models"""
+    if len(model_input_shape) == 2:
+        return windows
+    return np.eye(num_symbols, dtype="float32")[windows]
+
+def export_tflite(model_path, quantization=TFLITE_QUANTIZATION, batch_size=TFLITE_BATCH_SIZE,
+                  sequence_length=SEQUENCE_LENGTH, output_path=None):
+    """
+    Converts a trained .h5 model to TFLite.
+    :param quantization: "dynamic" stores the weights as int8 (activations stay float32),
+        None keeps everything float32. Full integer quantization isn't offered: with int8
+        activations the error builds up in the LSTM state over the window and the exports
+        fail validate_tflite
+    :param batch_size, sequence_length: the fixed input shape of the exported model
+    return output_path (str): the .tflite file
+    """
+    if quantization not in (None, "dynamic"):
+        raise ValueError("Quantization must be None or 'dynamic'")
+    output_path = output_path or tflite_path(model_path)
+
+    model = keras.models.load_model(model_path)
+    converter = tf.lite.TFLiteConverter.from_keras_model(fixed_shape_model(model, batch_size, sequence_length))
+    if quantization:
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+
+    with open(output_path, "wb") as fp:
+        fp.write(converter.convert())
+    return output_path
+
+def kl_divergence(p, q, epsilon=1e-7):
+    """KL(p || q) of every row of two batches of distributions (renormalized, quantized
+    softmax outputs don't sum to exactly 1)"""
+    p = np.clip(p, epsilon, 1.0)
+    q = np.clip(q, epsilon, 1.0)
+    p = p / p.sum(axis=-1, keepdims=True)
+    q = q / q.sum(axis=-1, keepdims=True)
+    return np.sum(p * np.log(p / q), axis=-1)
+
+def validate_tflite(model_path, tflite_model_path=None, num_windows=TFLITE_VALIDATION_WINDOWS,
+                    max_kl=TFLITE_MAX_KL, seed=42):
+    """
+    Compares the next symbol distributions of the Keras and the TFLite model on windows of
+    the dataset
+    return report (dict): mean and max KL(keras || tflite), how often both pick the same most
+        likely symbol, and whether the mean KL is within max_kl
+    """
+    model = keras.models.load_model(model_path)
+    lite_model = TFLiteModel(tflite_model_path or tflite_path(model_path))
+    num_symbols = model.output_shape[-1]
+
+    windows = sample_windows(num_windows, lite_model.input_shape[1], num_symbols, np.random.default_rng(seed))
+    model_input = encode_windows(windows, model.input_shape, num_symbols)
+    expected = np.concatenate([
+        model(model_input[start:start + 64], training=False).numpy() for start in range(0, len(model_input), 64)
+    ])
+    actual = lite_model(model_input)
+
+    divergences = kl_divergence(expected, actual)
+    return {
+        "mean_kl": float(divergences.mean()),
+        "max_kl": float(divergences.max()),
+        "top1_agreement": float(np.mean(expected.argmax(axis=-1) == actual.argmax(axis=-1))),
+        "passed": bool(divergences.mean() <= max_kl)
+    }
+
+def main():
+    """python3 tflite_export.py [lstm] [bilstm] [--quantization=dynamic|none]"""
+    quantization = TFLITE_QUANTIZATION
+    model_types = []
+    for arg in sys.argv[1:]:
+        if arg.startswith("--quantization="):
+            quantization = arg.split("=", 1)[1]
+            quantization = None if quantization == "none" else quantization
+        else:
+            model_types.append(arg)
+
+    for model_type in model_types or ("lstm", "bilstm"):
+        model_path = MODEL_PATHS[model_type]
+        output_path = export_tflite(model_path, quantization)
+        report = validate_tflite(model_path, output_path)
+        print(f"{model_type}: {model_path} ({os.path.getsize(model_path) / 1024:.0f} KB) -> {output_path} "
+              f"({os.path.getsize(output_path) / 1024:.0f} KB, {quantization or 'float32'}) | "
+              f"KL mean {report['mean_kl']:.5f} max {report['max_kl']:.5f}, "
+              f"top-1 agreement {report['top1_agreement']:.1%} | {'OK' if report['passed'] else 'FAILED'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+import numpy as np
+from config import TFLITE_NUM_THREADS
+
+try:
+    # the standalone LiteRT runtime, if installed
+    from ai_edge_litert.interpreter import Interpreter
+except ImportError:
+    import tensorflow as tf
+    Interpreter = tf.lite.Interpreter
+
+
+class TFLiteModel:
+    """
+    Runs a model exported by tflite_export.py with the TFLite interpreter, as a drop-in for
+    the Keras model in MelodyGenerator: called with a batch of inputs, returns the next
+    symbol probabilities as a numpy array.
+    The exported model has a fixed batch size and window length. Its tensors are allocated
+    once when it's loaded; inputs are written straight into the interpreter's input buffer,
+    a bigger batch is run in chunks and the last chunk is padded.
+    """
+
+    def __init__(self, model_path, num_threads=TFLITE_NUM_THREADS):
+        self.model_path = model_path
+        self.interpreter = Interpreter(model_path=model_path, num_threads=num_threads)
+        self.interpreter.allocate_tensors()
+
+        input_details = self.interpreter.get_input_details()[0]
+        output_details = self.interpreter.get_output_details()[0]
+        self.batch_size = int(input_details["shape"][0])
+        self.input_shape = (None,) + tuple(int(size) for size in input_details["shape"][1:])
+        self.output_shape = (None,) + tuple(int(size) for size in output_details["shape"][1:])
+        self.input_dtype = np.dtype(input_details["dtype"])
+
+        # callables returning views of the interpreter's buffers; the views mustn't be kept
+        # across invoke, so they are fetched again for every chunk
+        self._input = self.interpreter.tensor(input_details["index"])
+        self._output = self.interpreter.tensor(output_details["index"])
+
+    def __call__(self, model_input):
+        """
+        :param model_input: batch of windows, of the window length the model was exported with
+        return probabilities (np.ndarray): one distribution per window
+        """
+        if tuple(model_input.shape[1:]) != self.input_shape[1:]:
+            raise ValueError(
+                f"{self.model_path} was exported for inputs of shape {self.input_shape[1:]}, got "
+                f"{tuple(model_input.shape[1:])}; generate with max_sequence_length={self.input_shape[1]}"
+            )
+
+        probabilities = np.empty((len(model_input),) + self.output_shape[1:], dtype="float32")
+        for start in range(0, len(model_input), self.batch_size):
+            chunk = model_input[start:start + self.batch_size]
+            self._input()[:len(chunk)] = chunk
+            self._input()[len(chunk):] = 0
+            self.interpreter.invoke()
+            probabilities[start:start + len(chunk)] = self._output()[:len(chunk)]
+        return probabilities
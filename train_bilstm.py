@@ -1,6 +1,9 @@
 import tensorflow.keras as keras
-from preprocess import generate_training_sequences
-from config import OUTPUT_UNITS, LOSS, LEARNING_RATE, EPOCHS, BATCH_SIZE, SEQUENCE_LENGTH
+from preprocess import generate_training_sequences, create_training_datasets, add_time
+from config import OUTPUT_UNITS, LOSS, LEARNING_RATE, EPOCHS, BATCH_SIZE, SEQUENCE_LENGTH, STREAM_TRAINING_DATA, EMBEDDING_DIM, TRAINING_COLLECTIONS, TRAINING_PROFILE
+from training_profile import apply_training_profile, fused_lstm_problems
+from dataset_shards import build_training_dataset
+from vocabulary import vocabulary_size, save_model_vocabulary
 from bilstm_model import build_bilstm_model
 import time
 from sklearn.model_selection import train_test_split
@@ -14,51 +17,107 @@ def train_bilstm(
     sequence_length=SEQUENCE_LENGTH,
     lstm_units=512,
     dropout_rate=0.2,
-    dense_units=32
+    dense_units=32,
+    stream_training_data=STREAM_TRAINING_DATA,
+    embedding_dim=EMBEDDING_DIM,
+    collections=TRAINING_COLLECTIONS,
+    data=None,
+    callbacks=None,
+    timings=None,
+    profile=TRAINING_PROFILE
 ):
     """
     Train the Bi-LSTM model and return training history and metrics.
+    data: optional (X_train, X_val, y_train, y_val) split prepared once and shared between
+    trainings, used instead of generating the training sequences again
+    callbacks: extra Keras callbacks passed to fit
+    timings: dict of seconds per stage (dataset, sequences, one-hot, split, build, fit,
+    evaluate, save), updated in place
+    profile: "default" or "performance" (mixed precision, XLA, thread pools, see config.py)
     """
-    # Generate the training sequences
-    X, y = generate_training_sequences(sequence_length)
-    
-    # Split the data into training and validation sets
-    X_train, X_val, y_train, y_val = train_test_split(X, y, test_size=0.2, random_state=42)
+    stage_start = time.perf_counter()
+    profile_settings = apply_training_profile(profile)
+
+    # Assemble the token dataset of the chosen collections from their shards
+    if collections:
+        build_training_dataset(collections, sequence_length=sequence_length)
+
+    # The output layer (and one-hot input) covers the whole vocabulary
+    if output_units is None:
+        output_units = vocabulary_size()
+    stage_start = add_time(timings, "dataset", stage_start)
+
+    if stream_training_data:
+        # Stream batches of windows from the token dataset
+        train_data, val_data = create_training_datasets(
+            sequence_length, batch_size, one_hot=not embedding_dim
+        )
+    elif data is not None:
+        X_train, X_val, y_train, y_val = data
+    else:
+        # Generate the training sequences
+        X, y = generate_training_sequences(sequence_length, one_hot=not embedding_dim, timings=timings)
+        stage_start = time.perf_counter()
+
+        # Split the data into training and validation sets
+        X_train, X_val, y_train, y_val = train_test_split(X, y, test_size=0.2, random_state=42)
+    stage_start = add_time(timings, "split", stage_start)
 
     # Build the Bi-LSTM model
     model = build_bilstm_model(
         output_units=output_units,
         lstm_units=lstm_units,
         dropout_rate=dropout_rate,
-        dense_units=dense_units
+        dense_units=dense_units,
+        embedding_dim=embedding_dim
     )
 
     # Compile the model
     model.compile(
         loss=loss,
         optimizer=keras.optimizers.Adam(learning_rate=learning_rate),
-        metrics=["accuracy"]
+        metrics=["accuracy"],
+        jit_compile=profile_settings["jit_compile"]
     )
+    for problem in fused_lstm_problems(model):
+        print(f"Warning: {problem}")
 
     model.summary()
+    stage_start = add_time(timings, "build", stage_start)
 
     # Training with timing and metrics
-    start_time = time.time()
-    
-    history = model.fit(
-        X_train, y_train,
-        validation_data=(X_val, y_val),
-        epochs=epochs,
-        batch_size=batch_size
-    )
+    start_time = time.perf_counter()
+
+    if stream_training_data:
+        history = model.fit(
+            train_data,
+            validation_data=val_data,
+            epochs=epochs,
+            callbacks=callbacks
+        )
+    else:
+        history = model.fit(
+            X_train, y_train,
+            validation_data=(X_val, y_val),
+            epochs=epochs,
+            batch_size=batch_size,
+            callbacks=callbacks
+        )
 
-    training_time = time.time() - start_time
+    training_time = time.perf_counter() - start_time
+    stage_start = add_time(timings, "fit", start_time)
 
     # Evaluate the model
-    test_loss, test_accuracy = model.evaluate(X_val, y_val)
-    
+    if stream_training_data:
+        test_loss, test_accuracy = model.evaluate(val_data)
+    else:
+        test_loss, test_accuracy = model.evaluate(X_val, y_val)
+    stage_start = add_time(timings, "evaluate", stage_start)
+
     # Save the model
     model.save("bilstm_model.h5")
+    save_model_vocabulary("bilstm_model.h5")
+    add_time(timings, "save", stage_start)
 
     return history, training_time, test_loss, test_accuracy
 
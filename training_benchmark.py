@@ -0,0 +1,221 @@
+import os
+import sys
+import json
+import time
+import inspect
+import platform
+import resource
+import subprocess
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import tensorflow.keras as keras
+from dataset_shards import build_shards, build_training_dataset
+from preprocess import load_int_dataset, add_time
+from training_runner import get_trainer
+from config import (BATCH_SIZE, SEQUENCE_LENGTH, SHARDS_DIR, BENCHMARK_COLLECTIONS, BENCHMARK_DIR,
+                    BENCHMARK_RESULTS_PATH, BENCHMARK_EPOCHS, BENCHMARK_BATCH_SIZES, BENCHMARK_SEQUENCE_LENGTHS,
+                    BENCHMARK_NUM_UNITS)
+
+
+class ThroughputCallback(keras.callbacks.Callback):
+    """Times every training step and reports, per epoch, the wall time, step times and samples/sec"""
+
+    def __init__(self, batch_size, num_samples=None):
+        """
+        :param batch_size: batch size of the fit, used to count samples
+        :param num_samples: training samples per epoch, if known (the last batch may be smaller)
+        """
+        super().__init__()
+        self.batch_size = batch_size
+        self.num_samples = num_samples
+        self.epochs = []
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._epoch_start = time.perf_counter()
+        self._step_times = []
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self._step_start = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        self._step_times.append(time.perf_counter() - self._step_start)
+
+    def on_epoch_end(self, epoch, logs=None):
+        seconds = time.perf_counter() - self._epoch_start
+        step_times = np.array(self._step_times)
+        num_samples = self.num_samples or len(step_times) * self.batch_size
+        self.epochs.append({
+            "epoch": epoch,
+            "seconds": seconds,
+            "steps": len(step_times),
+            "mean_step_ms": 1000 * float(step_times.mean()),
+            # the first step of the first epoch includes tracing the train function
+            "median_step_ms": 1000 * float(np.median(step_times)),
+            "samples_per_second": num_samples / float(step_times.sum())
+        })
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def sweep_settings(model_type, batch_sizes=BENCHMARK_BATCH_SIZES, sequence_lengths=BENCHMARK_SEQUENCE_LENGTHS,
+                   num_units=BENCHMARK_NUM_UNITS):
+    """The baseline (BATCH_SIZE, SEQUENCE_LENGTH and the model's default lstm_units, the
+    configuration that actually gets trained) and every value of the sweeps, changing one
+    setting at a time"""
+    lstm_units = inspect.signature(get_trainer(model_type)).parameters["lstm_units"].default
+    baseline = {"batch_size": BATCH_SIZE, "sequence_length": SEQUENCE_LENGTH, "lstm_units": lstm_units}
+    settings = [baseline]
+    for name, values in (("batch_size", batch_sizes), ("sequence_length", sequence_lengths), ("lstm_units", num_units)):
+        settings.extend(dict(baseline, **{name: value}) for value in values if value != baseline[name])
+    return settings
+
+def run_key(run):
+    return (run["model"], run["batch_size"], run["sequence_length"], run["lstm_units"], run.get("profile", "default"))
+
+def _benchmark_run(model_type, settings, collections, epochs, shards_dir, run_dir):
+    """
+    One training run, in its own process so that the peak RSS is its own. Works in run_dir,
+    so the dataset, vocabulary and model it writes don't replace the ones used for training
+    """
+    trainer = get_trainer(model_type)
+    os.makedirs(run_dir, exist_ok=True)
+    os.chdir(run_dir)
+
+    timings = {}
+    start_time = time.perf_counter()
+    build_training_dataset(collections, shards_dir=shards_dir, sequence_length=settings["sequence_length"])
+    add_time(timings, "dataset", start_time)
+
+    # same split as train_test_split(test_size=0.2)
+    num_windows = len(load_int_dataset()) - settings["sequence_length"]
+    num_train = num_windows - int(np.ceil(num_windows * 0.2))
+
+    throughput = ThroughputCallback(settings["batch_size"], num_train)
+    _, training_time, test_loss, test_accuracy = trainer(
+        epochs=epochs, collections=None, callbacks=[throughput], timings=timings, **settings
+    )
+
+    return dict(
+        model=model_type,
+        **settings,
+        num_train_samples=num_train,
+        samples_per_second=num_train * epochs / training_time,
+        training_time=training_time,
+        test_loss=float(test_loss),
+        test_accuracy=float(test_accuracy),
+        stages=timings,
+        epochs=throughput.epochs,
+        # kilobytes on Linux
+        peak_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    )
+
+def load_results(results_path=BENCHMARK_RESULTS_PATH):
+    if not os.path.exists(results_path):
+        return []
+    with open(results_path, "r") as fp:
+        return json.load(fp)
+
+def print_comparison(session, previous):
+    """Samples/sec, step time and peak memory of every run, next to the previous session's"""
+    previous_runs = {run_key(run): run for run in previous["runs"]} if previous else {}
+    print(f"\n{'model':7s} {'batch':>5s} {'seq':>4s} {'units':>5s} {'samples/s':>10s} {'step ms':>8s} "
+          f"{'one-hot s':>9s} {'RSS MB':>7s}  vs {previous['timestamp'] + ' ' + str(previous['commit']) if previous else '-'}")
+
+    for run in session["runs"]:
+        median_step_ms = run["epochs"][-1]["median_step_ms"]
+        line = (f"{run['model']:7s} {run['batch_size']:5d} {run['sequence_length']:4d} {run['lstm_units']:5d} "
+                f"{run['samples_per_second']:10.1f} {median_step_ms:8.2f} {run['stages'].get('one-hot', 0):9.2f} "
+                f"{run['peak_rss_mb']:7.0f}")
+        if run.get("profile", "default") != "default":
+            line += f"  [{run['profile']}]"
+        before = previous_runs.get(run_key(run))
+        if before:
+            change = run["samples_per_second"] / before["samples_per_second"] - 1
+            line += f"  {before['samples_per_second']:10.1f} samples/s ({change:+.1%})"
+        print(line)
+
+def benchmark_training(model_types=("lstm", "bilstm"), settings=None, collections=BENCHMARK_COLLECTIONS,
+                       epochs=BENCHMARK_EPOCHS, results_path=BENCHMARK_RESULTS_PATH, run_dir=BENCHMARK_DIR,
+                       profiles=("default",)):
+    """
+    Trains every model with every setting of the sweep, under every training profile, on a
+    fixed subset of deutschl and
+    appends the results to the JSON history in results_path, printed next to the last
+    session that used the same collections and epochs.
+    Each run records the time spent in every stage (dataset, sequences, one-hot, split,
+    build, fit, evaluate, save), samples/sec, per-epoch step times and its peak RSS.
+    :param settings: list of settings for every model, or model type -> list; defaults to
+        each model's sweep_settings
+    return session (dict):
+    """
+    build_shards(collections)
+
+    session = {
+        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "commit": git_commit(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "collections": list(collections),
+        "epochs": epochs,
+        "runs": []
+    }
+
+    context = mp.get_context("spawn")
+    for model_type in model_types:
+        model_settings = settings.get(model_type) if isinstance(settings, dict) else settings
+        for run_settings in [dict(run_settings, profile=profile) for run_settings in model_settings or sweep_settings(model_type)
+                             for profile in profiles]:
+            print(f"Benchmarking {model_type} {run_settings}")
+            # a fresh process per run, for an accurate peak RSS and no state shared between runs
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                session["runs"].append(executor.submit(
+                    _benchmark_run, model_type, run_settings, list(collections), epochs,
+                    os.path.abspath(SHARDS_DIR), os.path.abspath(run_dir)
+                ).result())
+
+    history = load_results(results_path)
+    previous = next((old for old in reversed(history)
+                     if old["collections"] == session["collections"] and old["epochs"] == epochs), None)
+    print_comparison(session, previous)
+
+    history.append(session)
+    with open(results_path, "w") as fp:
+        json.dump(history, fp, indent=4)
+    return session
+
+def compare_profiles(model_types=("lstm", "bilstm"), settings=None, collections=BENCHMARK_COLLECTIONS,
+                     epochs=BENCHMARK_EPOCHS, results_path=BENCHMARK_RESULTS_PATH, run_dir=BENCHMARK_DIR):
+    """
+    Benchmarks the same settings (by default each model's baseline) with the default and
+    the performance training profile (each run in a fresh process, so the precision policy
+    and thread pools don't leak) and prints the speedup of the performance profile in samples/sec
+    return session (dict):
+    """
+    settings = settings or {model_type: sweep_settings(model_type)[:1] for model_type in model_types}
+    session = benchmark_training(model_types, settings, collections, epochs, results_path, run_dir,
+                                 profiles=("default", "performance"))
+
+    runs = {run_key(run): run for run in session["runs"]}
+    print()
+    for key, run in runs.items():
+        if key[-1] != "performance":
+            continue
+        baseline = runs[key[:-1] + ("default",)]
+        speedup = run["samples_per_second"] / baseline["samples_per_second"]
+        print(f"{run['model']:7s} batch {run['batch_size']} seq {run['sequence_length']} units {run['lstm_units']}: "
+              f"{baseline['samples_per_second']:.1f} -> {run['samples_per_second']:.1f} samples/s "
+              f"({speedup:.2f}x), test loss {baseline['test_loss']:.4f} -> {run['test_loss']:.4f}")
+    return session
+
+
+if __name__ == "__main__":
+    if "--profiles" in sys.argv[1:]:
+        compare_profiles([arg for arg in sys.argv[1:] if arg != "--profiles"] or ("lstm", "bilstm"))
+    else:
+        benchmark_training(sys.argv[1:] or ("lstm", "bilstm"))
@@ -0,0 +1,70 @@
+import os
+import tensorflow as tf
+import tensorflow.keras as keras
+from config import (TRAINING_PROFILE, PERFORMANCE_MIXED_PRECISION, PERFORMANCE_JIT_COMPILE,
+                    PERFORMANCE_INTRA_OP_THREADS, PERFORMANCE_INTER_OP_THREADS)
+
+
+def cpu_supports_bfloat16():
+    """bfloat16 is only worth it with native instructions for it (AVX512_BF16 or AMX), on Linux"""
+    try:
+        with open("/proc/cpuinfo", "r") as fp:
+            flags = fp.read()
+    except OSError:
+        return False
+    return "avx512_bf16" in flags or "amx_bf16" in flags
+
+def apply_training_profile(profile=TRAINING_PROFILE):
+    """
+    Sets up TensorFlow for a training profile. "default" trains in float32 (resetting the
+    precision policy a previous performance run in the same process may have set); "performance"
+    sets the thread pool sizes, switches Keras to bfloat16 mixed precision when the CPU
+    supports it and asks for XLA compilation of the train step (PERFORMANCE_* in config.py).
+    Thread pools can only be sized before TensorFlow runs its first operation, so call this
+    at the start of the process
+    return settings (dict): what was applied; jit_compile is the value to pass to compile
+    """
+    if profile == "default":
+        keras.mixed_precision.set_global_policy("float32")
+        return {"profile": profile, "mixed_precision": False, "jit_compile": "auto", "threads": None}
+    if profile != "performance":
+        raise ValueError("Training profile must be either 'default' or 'performance'")
+
+    intra_op_threads = PERFORMANCE_INTRA_OP_THREADS or os.cpu_count()
+    try:
+        tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+        tf.config.threading.set_inter_op_parallelism_threads(PERFORMANCE_INTER_OP_THREADS)
+        threads = (intra_op_threads, PERFORMANCE_INTER_OP_THREADS)
+    except RuntimeError:
+        print("TensorFlow is already initialized, keeping its thread pools")
+        threads = None
+
+    mixed_precision = PERFORMANCE_MIXED_PRECISION and cpu_supports_bfloat16()
+    keras.mixed_precision.set_global_policy("mixed_bfloat16" if mixed_precision else "float32")
+
+    return {
+        "profile": profile,
+        "mixed_precision": mixed_precision,
+        "jit_compile": PERFORMANCE_JIT_COMPILE,
+        "threads": threads
+    }
+
+def fused_lstm_problems(model):
+    """
+    LSTM layers of the model (Bidirectional ones included) that can't use the fused LSTM
+    kernel: it needs tanh/sigmoid activations, no recurrent dropout, no unrolling and biases
+    return problems (list): one message per layer that isn't eligible
+    """
+    lstms = []
+    for layer in model.layers:
+        if isinstance(layer, keras.layers.Bidirectional):
+            lstms.extend([layer.forward_layer, layer.backward_layer])
+        elif isinstance(layer, keras.layers.LSTM):
+            lstms.append(layer)
+
+    problems = []
+    for lstm in lstms:
+        if (lstm.activation is not keras.activations.tanh or lstm.recurrent_activation is not keras.activations.sigmoid
+                or lstm.recurrent_dropout != 0 or lstm.unroll or not lstm.use_bias):
+            problems.append(f"{lstm.name} isn't eligible for the fused LSTM kernel")
+    return problems
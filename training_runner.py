@@ -0,0 +1,213 @@
+import os
+import json
+import time
+import hashlib
+import inspect
+import multiprocessing as mp
+from queue import Empty
+from multiprocessing import shared_memory
+import numpy as np
+from sklearn.model_selection import train_test_split
+from preprocess import generate_training_sequences
+from dataset_shards import build_training_dataset
+from vocabulary import load_vocabulary
+from config import SEQUENCE_LENGTH, INT_DATASET, STREAM_TRAINING_DATA, EMBEDDING_DIM, TRAINING_COLLECTIONS
+
+MODEL_PATHS = {
+    "lstm": "lstm_model.h5",
+    "bilstm": "bilstm_model.h5"
+}
+
+
+def get_trainer(model_type):
+    """Imported lazily so that worker processes can pin their thread pools before TensorFlow starts"""
+    if model_type == "lstm":
+        from train_lstm import train_lstm
+        return train_lstm
+    elif model_type == "bilstm":
+        from train_bilstm import train_bilstm
+        return train_bilstm
+    raise ValueError("Model type must be either 'lstm' or 'bilstm'")
+
+def dataset_hash(int_dataset_path=INT_DATASET):
+    """Hash of the token dataset and of the vocabulary it was encoded with"""
+    hasher = hashlib.sha256()
+    with open(int_dataset_path, "rb") as fp:
+        for block in iter(lambda: fp.read(1 << 20), b""):
+            hasher.update(block)
+    hasher.update(load_vocabulary()["fingerprint"].encode())
+    return hasher.hexdigest()
+
+def training_fingerprint(model_type, params, data_hash):
+    """Hash of everything a trained model depends on: model type, every argument of its
+    train function (defaults included) and the training data"""
+    arguments = inspect.signature(get_trainer(model_type)).bind(**params)
+    arguments.apply_defaults()
+    config = {name: value for name, value in arguments.arguments.items() if name not in ("data", "collections", "callbacks", "timings")}
+    config = json.dumps([model_type, config, data_hash], sort_keys=True, default=str)
+    return hashlib.sha256(config.encode()).hexdigest()
+
+def training_record_path(model_path):
+    """Results of the training that produced a model: lstm_model.h5 -> lstm_model.train.json"""
+    return os.path.splitext(model_path)[0] + ".train.json"
+
+def load_training_record(model_path, fingerprint):
+    """return record (dict): None unless the model exists and was trained with the same fingerprint"""
+    record_path = training_record_path(model_path)
+    if not os.path.exists(model_path) or not os.path.exists(record_path):
+        return None
+
+    with open(record_path, "r") as fp:
+        record = json.load(fp)
+    return record if record["fingerprint"] == fingerprint else None
+
+def save_training_record(model_path, record):
+    with open(training_record_path(model_path), "w") as fp:
+        json.dump(record, fp, indent=4)
+
+def prepare_training_data(sequence_length=SEQUENCE_LENGTH, one_hot=True):
+    """Builds the training sequences and the train/validation split once, the same way
+    the train functions do
+    return data (tuple): X_train, X_val, y_train, y_val
+    """
+    X, y = generate_training_sequences(sequence_length, one_hot=one_hot)
+    return tuple(train_test_split(X, y, test_size=0.2, random_state=42))
+
+def share_arrays(arrays):
+    """
+    Copies arrays into shared memory segments, so that worker processes can map them
+    without copying or pickling
+    return specs, segments: what attach_arrays needs, and the segments to unlink when done
+    """
+    specs = []
+    segments = []
+    for array in arrays:
+        segment = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=segment.buf)[...] = array
+        specs.append((segment.name, array.shape, array.dtype.str))
+        segments.append(segment)
+    return specs, segments
+
+def attach_arrays(specs):
+    """return arrays, segments: views of the shared segments (keep the segments referenced)"""
+    segments = [shared_memory.SharedMemory(name=name) for name, _, _ in specs]
+    arrays = tuple(
+        np.ndarray(shape, dtype=np.dtype(dtype), buffer=segment.buf)
+        for segment, (_, shape, dtype) in zip(segments, specs)
+    )
+    return arrays, segments
+
+def run_training(model_type, params, data=None):
+    """Trains one model and returns its results as a JSON friendly record"""
+    history, training_time, test_loss, test_accuracy = get_trainer(model_type)(data=data, **params)
+    return {
+        "history": {name: [float(value) for value in values] for name, values in history.history.items()},
+        "training_time": training_time,
+        "test_loss": float(test_loss),
+        "test_accuracy": float(test_accuracy)
+    }
+
+def _training_worker(model_type, params, data_specs, num_threads, results):
+    """Entry point of the training processes: pins the thread pools, maps the shared data and trains"""
+    if num_threads:
+        os.environ["OMP_NUM_THREADS"] = str(num_threads)
+        import tensorflow as tf
+        tf.config.threading.set_intra_op_parallelism_threads(num_threads)
+        tf.config.threading.set_inter_op_parallelism_threads(1)
+
+    data, segments = attach_arrays(data_specs) if data_specs else (None, [])
+    try:
+        results.put((model_type, run_training(model_type, params, data), None))
+    except Exception as e:
+        results.put((model_type, None, repr(e)))
+    finally:
+        del data
+        for segment in segments:
+            segment.close()
+
+def train_models(model_types=("lstm", "bilstm"), params=None, parallel=False, num_threads=None,
+                 retrain=False, collections=TRAINING_COLLECTIONS):
+    """
+    Trains several models on the same data, built once.
+    :param params: keyword arguments passed to every train function (epochs, batch_size...)
+    :param parallel: train the models at the same time, one process each; the training
+        split is put in shared memory and mapped by every process instead of being copied
+    :param num_threads: TensorFlow threads per process; defaults to the CPUs split evenly
+    :param retrain: train even when a model trained with the same config and data exists
+    :param collections: deutschl collections to assemble from their shards first
+    return results (dict): model type -> record with history, training_time, test_loss,
+        test_accuracy and whether the model was reused
+    """
+    params = dict(params or {})
+    collections = params.pop("collections", collections)
+    if collections:
+        build_training_dataset(collections, sequence_length=params.get("sequence_length", SEQUENCE_LENGTH))
+
+    # the dataset is assembled once here, not again by every train function
+    params["collections"] = None
+    data_hash = dataset_hash()
+    results = {}
+    pending = []
+    for model_type in model_types:
+        fingerprint = training_fingerprint(model_type, params, data_hash)
+        record = None if retrain else load_training_record(MODEL_PATHS[model_type], fingerprint)
+        if record is not None:
+            print(f"{model_type}: {MODEL_PATHS[model_type]} already trained with this config and data, skipping")
+            results[model_type] = dict(record, reused=True)
+        else:
+            pending.append((model_type, fingerprint))
+
+    if not pending:
+        return results
+
+    # the streaming pipeline already reads the memory mapped token dataset, shared by every process
+    data = None
+    if not params.get("stream_training_data", STREAM_TRAINING_DATA):
+        start_time = time.time()
+        embedding_dim = params.get("embedding_dim", EMBEDDING_DIM)
+        data = prepare_training_data(params.get("sequence_length", SEQUENCE_LENGTH), one_hot=not embedding_dim)
+        print(f"Training data built once in {time.time() - start_time:.2f} seconds")
+
+    if parallel and len(pending) > 1:
+        num_threads = num_threads or max(1, (os.cpu_count() or 1) // len(pending))
+        data_specs, segments = share_arrays(data) if data is not None else (None, [])
+        context = mp.get_context("spawn")
+        queue = context.Queue()
+        processes = [
+            context.Process(target=_training_worker, args=(model_type, params, data_specs, num_threads, queue))
+            for model_type, _ in pending
+        ]
+        try:
+            for process in processes:
+                process.start()
+            outcomes = {}
+            while len(outcomes) < len(processes):
+                try:
+                    model_type, record, error = queue.get(timeout=1.0)
+                except Empty:
+                    # a process that died without reporting (e.g. killed for memory) never will
+                    crashed = [process for process in processes if process.exitcode not in (None, 0)]
+                    if crashed:
+                        raise RuntimeError(f"A training process exited with code {crashed[0].exitcode}")
+                    continue
+                if error is not None:
+                    raise RuntimeError(f"Training the {model_type} model failed: {error}")
+                outcomes[model_type] = record
+            for process in processes:
+                process.join()
+        finally:
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+            for segment in segments:
+                segment.close()
+                segment.unlink()
+    else:
+        outcomes = {model_type: run_training(model_type, params, data) for model_type, _ in pending}
+
+    for model_type, fingerprint in pending:
+        record = dict(outcomes[model_type], fingerprint=fingerprint)
+        save_training_record(MODEL_PATHS[model_type], record)
+        results[model_type] = dict(record, reused=False)
+
+    return results
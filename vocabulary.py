@@ -0,0 +1,67 @@
+import os
+import json
+import hashlib
+from collections import Counter
+from config import MAPPING_PATH, VOCABULARY_PATH
+
+# bump when the way ids are assigned to symbols changes
+VOCABULARY_VERSION = 1
+
+
+def symbol_sort_key(symbol):
+    """MIDI numbers in numerical order first, then the other symbols ("/", "_", "r")"""
+    return (0, int(symbol), "") if symbol.isdigit() else (1, 0, symbol)
+
+def count_symbols(songs, symbol_counts=None):
+    """
+    Counts the symbols of encoded songs in one streaming pass
+    :param songs: iterable of encoded songs (or lines of a dataset file)
+    :param symbol_counts: Counter to update in place, e.g. when merging several datasets
+    return symbol_counts (Counter):
+    """
+    symbol_counts = Counter() if symbol_counts is None else symbol_counts
+    for song in songs:
+        symbol_counts.update(song.split())
+    return symbol_counts
+
+def build_vocabulary(symbol_counts):
+    """
+    Vocabulary with deterministic ids: symbols are sorted, so the same set of symbols always
+    gets the same ids whatever the order the songs were read in
+    return vocabulary (dict): symbols (index = id), counts and a fingerprint of the symbols
+    """
+    symbols = sorted(symbol_counts, key=symbol_sort_key)
+    return {
+        "version": VOCABULARY_VERSION,
+        "fingerprint": hashlib.sha256(json.dumps(symbols).encode()).hexdigest()[:16],
+        "symbols": symbols,
+        "counts": [int(symbol_counts[symbol]) for symbol in symbols]
+    }
+
+def mappings_from_vocabulary(vocabulary):
+    """return mappings (dict): symbol -> id, the format of mapping.json"""
+    return {symbol: i for i, symbol in enumerate(vocabulary["symbols"])}
+
+def save_vocabulary(vocabulary, vocabulary_path=VOCABULARY_PATH, mapping_path=MAPPING_PATH):
+    """Writes the vocabulary and the mapping.json derived from it"""
+    with open(vocabulary_path, "w") as fp:
+        json.dump(vocabulary, fp, indent=4)
+
+    if mapping_path:
+        with open(mapping_path, "w") as fp:
+            json.dump(mappings_from_vocabulary(vocabulary), fp, indent=4)
+
+def load_vocabulary(vocabulary_path=VOCABULARY_PATH):
+    with open(vocabulary_path, "r") as fp:
+        return json.load(fp)
+
+def vocabulary_size(vocabulary_path=VOCABULARY_PATH):
+    return len(load_vocabulary(vocabulary_path)["symbols"])
+
+def model_vocabulary_path(model_path):
+    """The vocabulary a model was trained with is kept next to it: lstm_model.h5 -> lstm_model.vocab.json"""
+    return os.path.splitext(model_path)[0] + ".vocab.json"
+
+def save_model_vocabulary(model_path, vocabulary_path=VOCABULARY_PATH):
+    """Versions the current vocabulary together with a saved model"""
+    save_vocabulary(load_vocabulary(vocabulary_path), model_vocabulary_path(model_path), mapping_path=None)